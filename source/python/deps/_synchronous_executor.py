@@ -4,15 +4,10 @@ when running synchronously.
 """
 
 
-class Future:
-    def __init__(self, callback, args):
-        try:
-            self._result = callback(*args)
-            self._exception = None
-        except Exception as err:
-            self._result = None
-            self._exception = err
-        self.callbacks = []
+class _Future:
+    """
+    Base for the (always done) futures returned by the `SynchronousExecutor`.
+    """
 
     def cancelled(self):
         return False
@@ -23,17 +18,30 @@ class Future:
     def done(self):
         return True
 
+    def add_done_callback(self, callback):
+        callback(self)
+
+
+class _OkFuture(_Future):
+    def __init__(self, result):
+        self._result = result
+
     def exception(self):
-        return self._exception
+        return None
 
     def result(self):
-        if self._exception is not None:
-            raise self._exception
-        else:
-            return self._result
+        return self._result
 
-    def add_done_callback(self, callback):
-        callback(self)
+
+class _ErrFuture(_Future):
+    def __init__(self, exception):
+        self._exception = exception
+
+    def exception(self):
+        return self._exception
+
+    def result(self):
+        raise self._exception
 
 
 class SynchronousExecutor:
@@ -42,7 +50,10 @@ class SynchronousExecutor:
     """
 
     def submit(self, callback, *args):
-        return Future(callback, args)
+        try:
+            return _OkFuture(callback(*args))
+        except Exception as err:
+            return _ErrFuture(err)
 
     def shutdown(self, wait):
         pass
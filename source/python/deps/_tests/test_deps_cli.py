@@ -1,116 +1,266 @@
+import fnmatch
+import functools
+import json
 import os
-import stat
+import re
+import subprocess
 import sys
-import textwrap
-from builtins import str
+import threading
 from pathlib import Path
 
 import pytest
-from _pytest.pytester import LineMatcher
 
 from deps import deps_cli
 
 
+@functools.lru_cache(maxsize=512)
+def _compile_fnmatch_pattern(pattern):
+    """
+    :rtype: re.Pattern
+    :return: The compiled regex for the given `fnmatch` pattern (cached, as many tests share the
+        same patterns).
+    """
+    return re.compile(fnmatch.translate(pattern))
+
+
+def fnmatch_lines(output, patterns):
+    """
+    Check that `output` contains lines matching the given `fnmatch` patterns, in order (same as
+    pytest's `LineMatcher.fnmatch_lines`, but compiling each pattern only once).
+
+    :type output: str
+    :type patterns: list(str)
+    """
+    remaining_lines = iter(output.splitlines())
+    for pattern in patterns:
+        regex = _compile_fnmatch_pattern(pattern)
+        for line in remaining_lines:
+            if line == pattern or regex.match(line):
+                break
+        else:
+            pytest.fail(
+                "no match for: {!r}\n\nin:\n{}".format(pattern, output),
+                pytrace=False,
+            )
+
+
+def fnmatch_lines_random(output, patterns):
+    """
+    Check that each of the given `fnmatch` patterns matches some line of `output`, in any order
+    (same as pytest's `LineMatcher.fnmatch_lines_random`).
+
+    :type output: str
+    :type patterns: list(str)
+    """
+    lines = output.splitlines()
+    for pattern in patterns:
+        regex = _compile_fnmatch_pattern(pattern)
+        if not any(line == pattern or regex.match(line) for line in lines):
+            pytest.fail(
+                "line {!r} not found in output:\n{}".format(pattern, output),
+                pytrace=False,
+            )
+
+
+def invoke_deps(cli_runner, args=None, **kwargs):
+    """
+    Invoke the `deps` command line, checking that it succeeds.
+
+    :type cli_runner: click.testing.CliRunner
+    :type args: list(str) | None
+    :rtype: click.testing.Result
+    """
+    result = cli_runner.invoke(deps_cli.cli, args, **kwargs)
+    assert result.exit_code == 0, result.output
+    return result
+
+
 @pytest.fixture(autouse=True)
 def cleanup_env(monkeypatch):
     """
     Remove the GITHUB_WORKSPACE from the testing environment, otherwise the presence of this
     variable will cause all section outputs to contain ::group:: when running inside GH actions itself.
+
+    Also disable the persistent includes cache, so tests don't write to the user cache directory.
     """
     monkeypatch.delenv("GITHUB_WORKSPACE", raising=False)
+    monkeypatch.setenv("DEPS_CACHE_DIR", "")
 
 
-@pytest.fixture(scope="session")
-def project_tree(tmpdir_factory):
+# An entry of the `includes` list in the environment files created by `project_tree`.
+INCLUDE_ENTRY_TEMPLATE = "  - {{{{ root }}}}/../{}/environment.devenv.yml\n"
+
+# Scripts created in the `tasks` directory of some projects by `project_tree`.
+BATCH_SCRIPT = """\
+@echo Sample script %*
+"""
+BASH_SCRIPT = """\
+#!/bin/bash
+echo Sample script "$@"
+"""
+PYTHON_SCRIPT = """\
+import os
+import sys
+print "From python script!"
+print " - sys.argv: {};".format(' '.join(sys.argv[1:]))
+print " - cwd: {};".format(os.getcwd())
+"""
+
+# Expected outputs of listing the projects (in execution order) in some tests.
+NO_ARGS_OUTPUT = """\
+dep_z
+dep_b.1.1
+dep_b.1
+root_b
+"""
+NO_ARGS_CYCLIC_DEPS_OUTPUT = """\
+dep_c2.1
+dep_c1.3
+dep_c1.2
+dep_c1.1
+root_c
+"""
+MULTIPLE_PROJECTS_OUTPUT = """\
+dep_z
+dep_a.1.2
+dep_a.1.1
+dep_a.2
+dep_a.1
+root_a
+dep_b.1.1
+dep_b.1
+root_b
+"""
+IGNORE_PROJECTS_OUTPUT = """\
+dep_a.2
+root_a
+"""
+SKIP_PROJECTS_OUTPUT = """\
+dep_a.1.2
+dep_a.1.1
+dep_a.2
+root_a
+"""
+CONFLICT_IGNORE_SKIP_PROJECTS_OUTPUT = """\
+dep_z
+dep_a.2
+root_a
+"""
+REQUIRE_FILE_OUTPUT = """\
+dep_z
+root_b
+"""
+
+
+# The projects created by `project_tree`, with their dependencies.
+PROJECTS = (
+    ("root_a", ("dep_a.1", "dep_a.2")),
+    ("root_b", ("bs/dep_b.1",)),
+    ("dep_a.1", ("dep_a.1.1", "dep_a.1.2")),
+    ("dep_a.2", ("dep_z",)),
+    ("dep_a.1.1", ("dep_z",)),
+    ("dep_a.1.2", ("dep_z",)),
+    ("bs/dep_b.1", ("dep_b.1.1",)),
+    ("bs/dep_b.1.1", ("../dep_z",)),
+    ("dep_z", ()),
+    ("root_c", ("cs1/dep_c1.1",)),
+    ("cs1/dep_c1.1", ("dep_c1.2",)),
+    ("cs1/dep_c1.2", ("dep_c1.3", "dep_c1.1")),
+    ("cs1/dep_c1.3", ("dep_c1.1", "../cs2/dep_c2.1")),
+    ("cs2/dep_c2.1", ("../cs1/dep_c1.2",)),
+    ("root_d", ("d/d1", "d/d2", "d/d3")),
+    ("d/d1", ()),
+    ("d/d2", ()),
+    ("d/d3", ()),
+)
+
+
+def _render_environment_file(proj, deps):
     """
-    :type tmpdir_factory: _pytest.tmpdir.TempdirFactory
-    :rtype: py.path.local
+    :param str proj: The project name.
+    :param tuple(str, ...) deps: The dependencies of the project.
+    :rtype: bytes
+    :return: The contents of the environment file of the project.
     """
-    test_projects = tmpdir_factory.mktemp("test_projects")
-    projects = {
-        "root_a": ["dep_a.1", "dep_a.2"],
-        "root_b": ["bs/dep_b.1"],
-        "dep_a.1": ["dep_a.1.1", "dep_a.1.2"],
-        "dep_a.2": ["dep_z"],
-        "dep_a.1.1": ["dep_z"],
-        "dep_a.1.2": ["dep_z"],
-        "bs/dep_b.1": ["dep_b.1.1"],
-        "bs/dep_b.1.1": ["../dep_z"],
-        "dep_z": [],
-        "root_c": ["cs1/dep_c1.1"],
-        "cs1/dep_c1.1": ["dep_c1.2"],
-        "cs1/dep_c1.2": ["dep_c1.3", "dep_c1.1"],
-        "cs1/dep_c1.3": ["dep_c1.1", "../cs2/dep_c2.1"],
-        "cs2/dep_c2.1": ["../cs1/dep_c1.2"],
-        "root_d": ["d/d1", "d/d2", "d/d3"],
-        "d/d1": [],
-        "d/d2": [],
-        "d/d3": [],
-    }
-    for proj, deps in projects.items():
-        proj_path = proj.split("/")
-        proj_dir = test_projects.ensure(*proj_path, dir=True)
-        test_projects.ensure(proj_path[0], ".git", dir=True)  # Fake git repo.
-        env_yml = proj_dir.join("environment.devenv.yml")
-        env_content = ["name: {}".format(proj), ""]
-        if len(deps) > 0:
-            env_content.append("includes:")
-            env_content.extend(
-                [
-                    "  - {{{{ root }}}}/../{}/environment.devenv.yml".format(dep)
-                    for dep in deps
-                ]
-            )
-            env_content.append("")
-        env_yml.write("\n".join(env_content))
+    if deps:
+        includes = "".join(INCLUDE_ENTRY_TEMPLATE.format(dep) for dep in deps)
+        return f"name: {proj}\n\nincludes:\n{includes}".encode()
+    return f"name: {proj}\n".encode()
+
+
+# The environment files are the same on every session, so render them only once.
+ENVIRONMENT_FILES = {
+    proj: _render_environment_file(proj, deps) for proj, deps in PROJECTS
+}
+
+
+def _build_project_tree(base):
+    """
+    Create the test projects (and the scripts used by some tests) under `base`.
+
+    :param pathlib.Path base: An existing (empty) directory.
+    """
+    seen_roots = set()
+    for proj, _deps in PROJECTS:
+        root = proj.split("/")[0]
+        if root not in seen_roots:
+            (base / root / ".git").mkdir(parents=True)  # Fake git repo.
+            seen_roots.add(root)
+
+    for proj, contents in ENVIRONMENT_FILES.items():
+        proj_dir = base / proj
+        proj_dir.mkdir(parents=True, exist_ok=True)
+        (proj_dir / "environment.devenv.yml").write_bytes(contents)
     # Add a non-project folder.
-    test_projects.mkdir("not_a_project")
-    # Add test scripts to some projects.
-    batch_script = textwrap.dedent(
-        """\
-        @echo Sample script %*
-        """
-    )
-    bash_script = textwrap.dedent(
-        """\
-        #!/bin/bash
-        echo Sample script "$@"
-        """
-    )
-    python_script = textwrap.dedent(
-        """\
-        import os
-        import sys
-        print "From python script!"
-        print " - sys.argv: {};".format(' '.join(sys.argv[1:]))
-        print " - cwd: {};".format(os.getcwd())
-        """
-    )
+    (base / "not_a_project").mkdir()
+    # Add test scripts to some projects. `tasks/asd` is executed through `asd.bat` on Windows, but
+    # the `asd` file must exist there too (it is used by `--require-file`).
+    scripts = {"asd": BASH_SCRIPT, "asd.py": PYTHON_SCRIPT}
+    if sys.platform.startswith("win"):
+        scripts["asd.bat"] = BATCH_SCRIPT
     for proj in ["root_a", "root_b", "dep_z"]:
-        tasks_dir = test_projects.join(proj).mkdir("tasks")
-        script_file = tasks_dir.join("asd.bat")
-        script_file.write(batch_script)
+        tasks_dir = base / proj / "tasks"
+        tasks_dir.mkdir()
+        for script_name, script in scripts.items():
+            # Create the bash script already executable, instead of changing its mode afterwards
+            # (the executable bit has no effect on Windows).
+            mode = 0o777 if script_name == "asd" else 0o666
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+            with open(os.open(tasks_dir / script_name, flags, mode), "w") as f:
+                f.write(script)
 
-        script_file = tasks_dir.join("asd")
-        script_file.write(bash_script)
-        script_file = str(script_file)
-        st = os.stat(script_file)
-        os.chmod(script_file, st.st_mode | stat.S_IEXEC)
 
-        script_file = tasks_dir.join("asd.py")
-        script_file.write(python_script)
+@pytest.fixture(scope="session")
+def project_tree(tmp_path_factory):
+    """
+    The tree is built once per session and must be treated as read-only by the tests (tests that
+    need to change project files create their own projects).
 
+    :type tmp_path_factory: _pytest.tmpdir.TempPathFactory
+    :rtype: pathlib.Path
+    """
+    test_projects = tmp_path_factory.mktemp("test_projects", numbered=False)
+    _build_project_tree(test_projects)
     return test_projects
 
 
+@pytest.fixture(scope="session")
+def project_dirs(project_tree):
+    """
+    :type project_tree: pathlib.Path
+    :rtype: dict(str, str)
+    :return: The directory of each project in `project_tree`, by the project name in `PROJECTS`.
+    """
+    return {proj: str(project_tree / proj) for proj, _deps in PROJECTS}
+
+
 def test_deps_help(cli_runner):
     """
     :type cli_runner: click.testing.CliRunner
     """
-    result = cli_runner.invoke(deps_cli.cli, ["--help"])
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    result = invoke_deps(cli_runner, ["--help"])
+    fnmatch_lines(
+        result.output,
         [
             "Usage: deps [OPTIONS] [COMMAND]...",  # Basic usage.
             "Options:",  # Options header.
@@ -118,183 +268,126 @@ def test_deps_help(cli_runner):
             "*",  # Details.
             "*",  # Details.
             # ...
-        ]
+        ],
     )
 
 
-def test_no_args(cli_runner, project_tree, monkeypatch):
+def test_no_args(cli_runner, project_dirs, monkeypatch):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type monkeypatch: _pytest.monkeypatch
     """
-    monkeypatch.chdir(project_tree.join("root_b"))
-    result = cli_runner.invoke(deps_cli.cli)
-    assert result.exit_code == 0, result.output
-    assert result.output == textwrap.dedent(
-        """\
-        dep_z
-        dep_b.1.1
-        dep_b.1
-        root_b
-        """
-    )
+    monkeypatch.chdir(project_dirs["root_b"])
+    result = invoke_deps(cli_runner)
+    assert result.output == NO_ARGS_OUTPUT
 
 
-def test_no_args_cyclic_deps(cli_runner, project_tree, monkeypatch):
+def test_no_args_cyclic_deps(cli_runner, project_dirs, monkeypatch):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type monkeypatch: _pytest.monkeypatch
     """
-    monkeypatch.chdir(project_tree.join("root_c"))
-    result = cli_runner.invoke(deps_cli.cli)
-    assert result.exit_code == 0, result.output
-    assert result.output == textwrap.dedent(
-        """\
-        dep_c2.1
-        dep_c1.3
-        dep_c1.2
-        dep_c1.1
-        root_c
-        """
-    )
+    monkeypatch.chdir(project_dirs["root_c"])
+    result = invoke_deps(cli_runner)
+    assert result.output == NO_ARGS_CYCLIC_DEPS_OUTPUT
 
 
 def test_cant_find_root(cli_runner, project_tree, piped_shell_execute):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_tree: pathlib.Path
     :type piped_shell_execute: mocker.patch
     """
-    proj_dir = str(project_tree.join("not_a_project"))
+    proj_dir = str(project_tree / "not_a_project")
     command_args = ["-p", proj_dir, "echo", "Hi", "{name}!"]
     result = cli_runner.invoke(deps_cli.cli, command_args)
     assert result.exception is None or isinstance(result.exception, SystemExit)
     assert result.exit_code != 0
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    fnmatch_lines(
+        result.output,
         [
-            'deps: error: could not find "environment.devenv.yml" for "*[\\/]test_projects0[\\/]not_a_project".',
-        ]
+            'deps: error: could not find "environment.devenv.yml" for "*[\\/]test_projects[\\/]not_a_project".',
+        ],
     )
 
-    proj_dir = str(project_tree.join("not_a_valid_folder"))
+    proj_dir = str(project_tree / "not_a_valid_folder")
     command_args = ["-p", proj_dir, "echo", "Hi", "{name}!"]
     result = cli_runner.invoke(deps_cli.cli, command_args)
     assert result.exception is None or isinstance(result.exception, SystemExit)
     assert result.exit_code != 0
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    fnmatch_lines(
+        result.output,
         [
-            'deps: error: could not find "environment.devenv.yml" for "*[\\/]test_projects0[\\/]not_a_valid_folder".',
-        ]
+            'deps: error: could not find "environment.devenv.yml" for "*[\\/]test_projects[\\/]not_a_valid_folder".',
+        ],
     )
 
 
+@pytest.mark.parametrize("here", [False, True], ids=["project_dir", "here"])
 @pytest.mark.parametrize("on_github", [True, False])
-def test_execution_on_project_dir(cli_runner, project_tree, monkeypatch, on_github):
+def test_execution_on_project_dir(
+    cli_runner, project_dirs, monkeypatch, on_github, here, request
+):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type monkeypatch: _pytest.monkeypatch
+    :type on_github: bool
+    :type here: bool
+    :type request: _pytest.fixtures.FixtureRequest
     """
     if on_github:
+        # Only the group markers around the commands are checked, they don't need to run.
+        request.getfixturevalue("fake_shell_execute")
         monkeypatch.setenv("GITHUB_WORKSPACE", "some/path")
         expected_prefix = "::group::"
     else:
         expected_prefix = ""
-    monkeypatch.chdir(project_tree.join("root_b"))
+    monkeypatch.chdir(project_dirs["root_b"])
     command_args = ["-v", "--", "python", "-c", '"name: {name}"']
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            f"{expected_prefix}dep_z (1/4)",
-            'deps: executing: python -c "name:\\ dep_z"',
-            "deps: from:      *[\\/]test_projects0[\\/]dep_z",
-            "deps: return code: 0",
-            f"{expected_prefix}dep_b.1.1 (2/4)",
-            'deps: executing: python -c "name:\\ dep_b.1.1"',
-            "deps: from:      *[\\/]test_projects0[\\/]bs[\\/]dep_b.1.1",
-            "deps: return code: 0",
-            f"{expected_prefix}dep_b.1 (3/4)",
-            'deps: executing: python -c "name:\\ dep_b.1"',
-            "deps: from:      *[\\/]test_projects0[\\/]bs[\\/]dep_b.1",
-            "deps: return code: 0",
-            f"{expected_prefix}root_b (4/4)",
-            'deps: executing: python -c "name:\\ root_b"',
-            "deps: from:      *[\\/]test_projects0[\\/]root_b",
-            "deps: return code: 0",
+    if here:
+        command_args.insert(0, "--here")
+    result = invoke_deps(cli_runner, command_args)
+    expected_lines = []
+    for i, proj in enumerate(
+        ["dep_z", "bs/dep_b.1.1", "bs/dep_b.1", "root_b"], start=1
+    ):
+        name = proj.split("/")[-1]
+        expected_lines += [
+            f"{expected_prefix}{name} ({i}/4)",
+            f'deps: executing: python -c "name:\\ {name}"',
         ]
-    )
+        if not here:
+            # With `--here` the current working directory is not changed.
+            proj_pattern = proj.replace("/", "[\\/]")
+            expected_lines.append(
+                f"deps: from:      *[\\/]test_projects[\\/]{proj_pattern}"
+            )
+        expected_lines.append("deps: return code: 0")
+    fnmatch_lines(result.output, expected_lines)
     if on_github:
-        matcher.fnmatch_lines("::endgroup::")
-
+        fnmatch_lines(result.output, ["::endgroup::"])
 
-def test_here_flag(cli_runner, project_tree, monkeypatch):
-    """
-    :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type monkeypatch: _pytest.monkeypatch
-    """
-    monkeypatch.chdir(project_tree.join("root_b"))
-    command_args = ["-v", "--here", "--", "python", "-c", '"name: {name}"']
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    # Current working directory is not changed.
-    matcher.fnmatch_lines(
-        [
-            "dep_z (1/4)",
-            'deps: executing: python -c "name:\\ dep_z"',
-            "deps: return code: 0",
-            "dep_b.1.1 (2/4)",
-            'deps: executing: python -c "name:\\ dep_b.1.1"',
-            "deps: return code: 0",
-            "dep_b.1 (3/4)",
-            'deps: executing: python -c "name:\\ dep_b.1"',
-            "deps: return code: 0",
-            "root_b (4/4)",
-            'deps: executing: python -c "name:\\ root_b"',
-            "deps: return code: 0",
-        ]
-    )
 
-
-def test_multiple_projects(cli_runner, project_tree):
+def test_multiple_projects(cli_runner, project_dirs):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     """
-    projects = ["root_a", "root_b"]
-    projects = [str(project_tree.join(name)) for name in projects]
-    command_args = [("--project={}".format(project)) for project in projects]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    assert result.output == textwrap.dedent(
-        """\
-        dep_z
-        dep_a.1.2
-        dep_a.1.1
-        dep_a.2
-        dep_a.1
-        root_a
-        dep_b.1.1
-        dep_b.1
-        root_b
-        """
-    )
+    command_args = [f"--project={project_dirs[name]}" for name in ("root_a", "root_b")]
+    result = invoke_deps(cli_runner, command_args)
+    assert result.output == MULTIPLE_PROJECTS_OUTPUT
 
 
-def test_script_execution(cli_runner, project_tree, piped_shell_execute):
+def test_script_execution(cli_runner, project_dirs, piped_shell_execute):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
-    root_b = str(project_tree.join("root_b"))
+    root_b = project_dirs["root_b"]
     task_script = os.path.join("tasks", "asd")
     command_args = [
         "-p",
@@ -306,49 +399,48 @@ def test_script_execution(cli_runner, project_tree, piped_shell_execute):
         "{name}",
         "{abs}",
     ]
-    result = cli_runner.invoke(deps_cli.cli, command_args, catch_exceptions=False)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    result = invoke_deps(cli_runner, command_args, catch_exceptions=False)
+    fnmatch_lines(
+        result.output,
         [
             "dep_z (1/4)",
-            "deps: executing: tasks[\\/]asd dep_z *[\\/]test_projects0[\\/]dep_z",
-            "deps: from:      *[\\/]test_projects0[\\/]dep_z",
-            "Sample script dep_z *[\\/]test_projects0[\\/]dep_z",
+            "deps: executing: tasks[\\/]asd dep_z *[\\/]test_projects[\\/]dep_z",
+            "deps: from:      *[\\/]test_projects[\\/]dep_z",
+            "Sample script dep_z *[\\/]test_projects[\\/]dep_z",
             "",
             "deps: return code: 0",
             'dep_b.1.1: skipping since "*[\\/]tasks[\\/]asd" does not exist',
             'dep_b.1: skipping since "*[\\/]tasks[\\/]asd" does not exist',
             "root_b (4/4)",
-            "deps: executing: tasks[\\/]asd root_b *[\\/]test_projects0[\\/]root_b",
-            "deps: from:      *[\\/]test_projects0[\\/]root_b",
-            "Sample script root_b *[\\/]test_projects0[\\/]root_b",
+            "deps: executing: tasks[\\/]asd root_b *[\\/]test_projects[\\/]root_b",
+            "deps: from:      *[\\/]test_projects[\\/]root_b",
+            "Sample script root_b *[\\/]test_projects[\\/]root_b",
             "",
             "deps: return code: 0",
-        ]
+        ],
     )
 
 
-def test_script_return_code(cli_runner, project_tree, piped_shell_execute):
+def test_script_return_code(cli_runner, project_dirs, piped_shell_execute):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
-    root_b = str(project_tree.join("root_b"))
+    root_b = project_dirs["root_b"]
     task_script = os.path.join("tasks", "does-not-exist")
     command_args = ["-p", root_b, "-v", task_script, "{name}", "{abs}"]
     result = cli_runner.invoke(deps_cli.cli, command_args)
     assert result.exit_code != 0
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    fnmatch_lines(
+        result.output,
         [
             "dep_z (1/4)",
-            "deps: executing: tasks[\\/]does-not-exist dep_z *[\\/]test_projects0[\\/]dep_z",
-            "deps: from:      *[\\/]test_projects0[\\/]dep_z",
+            "deps: executing: tasks[\\/]does-not-exist dep_z *[\\/]test_projects[\\/]dep_z",
+            "deps: from:      *[\\/]test_projects[\\/]dep_z",
             "deps: return code: *",
             "deps: error: Command failed (project: dep_z)",
-        ]
+        ],
     )
 
 
@@ -370,15 +462,15 @@ def test_force_color(
     use_env_var,
     force,
     cli_runner,
-    project_tree,
-    piped_shell_execute,
+    project_dirs,
+    fake_shell_execute,
 ):
     """
     :type use_env_var: bool
     :type force: bool
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
+    :type project_dirs: dict(str, str)
+    :type fake_shell_execute: mocker.patch
     """
 
     def configure_force_color():
@@ -387,21 +479,19 @@ def test_force_color(
         else:
             command_args.insert(0, "--force-color" if force else "--no-force-color")
 
-    root_b = str(project_tree.join("root_b"))
+    root_b = project_dirs["root_b"]
     # Prepare the invocation.
     command_args = ["-v", "-p", root_b, "echo", "test", "{name}"]
     extra_env = {}
     configure_force_color()
 
     # Since `CliRunner.invoke` captures the output the stdout/stderr is not a tty.
-    result = cli_runner.invoke(
-        deps_cli.cli, command_args, env=extra_env, color=None, catch_exceptions=False
+    result = invoke_deps(
+        cli_runner, command_args, env=extra_env, color=None, catch_exceptions=False
     )
-    assert result.exit_code == 0, result.output
-    output_repr = repr(result.output)
     # CSI for Control Sequence Introducer (or Control Sequence Initiator).
-    ansi_csi_repr = "\\x1b["
-    assert (ansi_csi_repr in output_repr) == force
+    ansi_csi = "\x1b["
+    assert (ansi_csi in result.output) == force
 
 
 @pytest.mark.parametrize(
@@ -414,33 +504,29 @@ def test_force_color(
 def test_ignore_projects(
     use_env_var,
     cli_runner,
-    project_tree,
+    project_dirs,
     piped_shell_execute,
 ):
     """
     :type use_env_var: bool
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
 
-    def configure_ignored_projects():
-        if use_env_var:
-            extra_env["DEPS_IGNORE_PROJECT"] = str("dep_a.1{}dep_z".format(os.pathsep))
-        else:
-            command_args.insert(0, "--ignore-project=dep_a.1")
-            command_args.insert(1, "--ignore-project=dep_z")
-
-    root_a = str(project_tree.join("root_a"))
-    # Prepare the invocation.
-    command_args = ["-p", root_a, "echo", "test", "{name}"]
-    extra_env = {}
-    configure_ignored_projects()
-
-    result = cli_runner.invoke(deps_cli.cli, command_args, env=extra_env)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    # The same options are used to execute a command and to list the projects.
+    if use_env_var:
+        option_args = []
+        extra_env = {"DEPS_IGNORE_PROJECT": "dep_a.1{}dep_z".format(os.pathsep)}
+    else:
+        option_args = ["--ignore-project=dep_a.1", "--ignore-project=dep_z"]
+        extra_env = {}
+    option_args += ["-p", project_dirs["root_a"]]
+
+    command_args = option_args + ["echo", "test", "{name}"]
+    result = invoke_deps(cli_runner, command_args, env=extra_env)
+    fnmatch_lines(
+        result.output,
         [
             "dep_a.1 ignored",
             "dep_z ignored",
@@ -448,22 +534,11 @@ def test_ignore_projects(
             "test dep_a.2",
             "root_a (4/4)",
             "test root_a",
-        ]
+        ],
     )
 
-    # Prepare the invocation.
-    command_args = ["-p", root_a]
-    extra_env = {}
-    configure_ignored_projects()
-
-    result = cli_runner.invoke(deps_cli.cli, command_args, env=extra_env)
-    assert result.exit_code == 0, result.output
-    assert result.output == textwrap.dedent(
-        """\
-        dep_a.2
-        root_a
-        """
-    )
+    result = invoke_deps(cli_runner, option_args, env=extra_env)
+    assert result.output == IGNORE_PROJECTS_OUTPUT
 
 
 @pytest.mark.parametrize(
@@ -476,33 +551,29 @@ def test_ignore_projects(
 def test_skip_projects(
     use_env_var,
     cli_runner,
-    project_tree,
+    project_dirs,
     piped_shell_execute,
 ):
     """
     :type use_env_var: bool
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
 
-    def configure_skipped_projects():
-        if use_env_var:
-            extra_env["DEPS_SKIP_PROJECT"] = str("dep_a.1{}dep_z".format(os.pathsep))
-        else:
-            command_args.insert(0, "--skip-project=dep_a.1")
-            command_args.insert(1, "--skip-project=dep_z")
-
-    root_a = str(project_tree.join("root_a"))
-    # Prepare the invocation.
-    command_args = ["-p", root_a, "echo", "test", "{name}"]
-    extra_env = {}
-    configure_skipped_projects()
-
-    result = cli_runner.invoke(deps_cli.cli, command_args, env=extra_env)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    # The same options are used to execute a command and to list the projects.
+    if use_env_var:
+        option_args = []
+        extra_env = {"DEPS_SKIP_PROJECT": "dep_a.1{}dep_z".format(os.pathsep)}
+    else:
+        option_args = ["--skip-project=dep_a.1", "--skip-project=dep_z"]
+        extra_env = {}
+    option_args += ["-p", project_dirs["root_a"]]
+
+    command_args = option_args + ["echo", "test", "{name}"]
+    result = invoke_deps(cli_runner, command_args, env=extra_env)
+    fnmatch_lines(
+        result.output,
         [
             "dep_z skipped",
             "dep_a.1.2 (2/6)",
@@ -514,24 +585,11 @@ def test_skip_projects(
             "dep_a.1 skipped",
             "root_a (6/6)",
             "test root_a",
-        ]
+        ],
     )
 
-    # Prepare the invocation.
-    command_args = ["-p", root_a]
-    extra_env = {}
-    configure_skipped_projects()
-
-    result = cli_runner.invoke(deps_cli.cli, command_args, env=extra_env)
-    assert result.exit_code == 0, result.output
-    assert result.output == textwrap.dedent(
-        """\
-        dep_a.1.2
-        dep_a.1.1
-        dep_a.2
-        root_a
-        """
-    )
+    result = invoke_deps(cli_runner, option_args, env=extra_env)
+    assert result.output == SKIP_PROJECTS_OUTPUT
 
 
 @pytest.mark.parametrize(
@@ -544,34 +602,29 @@ def test_skip_projects(
 def test_conflict_ignore_skip_projects(
     use_env_var,
     cli_runner,
-    project_tree,
+    project_dirs,
     piped_shell_execute,
 ):
     """
     :type use_env_var: bool
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
 
-    def configure_skipped_projects():
-        if use_env_var:
-            extra_env["DEPS_SKIP_PROJECT"] = "dep_a.1"
-            extra_env["DEPS_IGNORE_PROJECT"] = "dep_a.1"
-        else:
-            command_args.insert(0, "--skip-project=dep_a.1")
-            command_args.insert(0, "--ignore-project=dep_a.1")
-
-    root_a = str(project_tree.join("root_a"))
-    # Prepare the invocation.
-    command_args = ["-p", root_a, "echo", "test", "{name}"]
-    extra_env = {}
-    configure_skipped_projects()
-
-    result = cli_runner.invoke(deps_cli.cli, command_args, env=extra_env)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    # The same options are used to execute a command and to list the projects.
+    if use_env_var:
+        option_args = []
+        extra_env = {"DEPS_SKIP_PROJECT": "dep_a.1", "DEPS_IGNORE_PROJECT": "dep_a.1"}
+    else:
+        option_args = ["--ignore-project=dep_a.1", "--skip-project=dep_a.1"]
+        extra_env = {}
+    option_args += ["-p", project_dirs["root_a"]]
+
+    command_args = option_args + ["echo", "test", "{name}"]
+    result = invoke_deps(cli_runner, command_args, env=extra_env)
+    fnmatch_lines(
+        result.output,
         [
             "dep_a.1 ignored",
             "dep_z (2/4)",
@@ -580,81 +633,62 @@ def test_conflict_ignore_skip_projects(
             "test dep_a.2",
             "root_a (4/4)",
             "test root_a",
-        ]
+        ],
     )
 
-    # Prepare the invocation.
-    command_args = ["-p", root_a]
-    extra_env = {}
-    configure_skipped_projects()
-
-    result = cli_runner.invoke(deps_cli.cli, command_args, env=extra_env)
-    assert result.exit_code == 0, result.output
-    assert result.output == textwrap.dedent(
-        """\
-        dep_z
-        dep_a.2
-        root_a
-        """
-    )
+    result = invoke_deps(cli_runner, option_args, env=extra_env)
+    assert result.output == CONFLICT_IGNORE_SKIP_PROJECTS_OUTPUT
 
 
-def test_require_file(cli_runner, project_tree, piped_shell_execute):
+def test_require_file(cli_runner, project_dirs, piped_shell_execute):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
-    root_b = str(project_tree.join("root_b"))
+    root_b = project_dirs["root_b"]
     base_args = ["-p", root_b, "--require-file", "tasks/asd"]
 
     command_args = base_args + ["-v", "echo", "This", "is", "{name}"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    result = invoke_deps(cli_runner, command_args)
+    fnmatch_lines(
+        result.output,
         [
             "dep_z (1/4)",
             "deps: executing: echo This is dep_z",
-            "deps: from:      *[\\/]test_projects0[\\/]dep_z",
+            "deps: from:      *[\\/]test_projects[\\/]dep_z",
             "This is dep_z",
             "deps: return code: 0",
-            'dep_b.1.1: skipping since "*[\\/]test_projects0[\\/]bs[\\/]dep_b.1.1[\\/]tasks[\\/]asd" does not exist',
-            'dep_b.1: skipping since "*[\\/]test_projects0[\\/]bs[\\/]dep_b.1[\\/]tasks[\\/]asd" does not exist',
+            'dep_b.1.1: skipping since "*[\\/]test_projects[\\/]bs[\\/]dep_b.1.1[\\/]tasks[\\/]asd" does not exist',
+            'dep_b.1: skipping since "*[\\/]test_projects[\\/]bs[\\/]dep_b.1[\\/]tasks[\\/]asd" does not exist',
             "root_b (4/4)",
             "deps: executing: echo This is root_b",
-            "deps: from:      *[\\/]test_projects0[\\/]root_b",
+            "deps: from:      *[\\/]test_projects[\\/]root_b",
             "This is root_b",
             "deps: return code: 0",
-        ]
+        ],
     )
 
     command_args = ["-p", root_b, "--require-file", "tasks/asd"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    assert result.output == textwrap.dedent(
-        """\
-        dep_z
-        root_b
-        """
-    )
+    result = invoke_deps(cli_runner, command_args)
+    assert result.output == REQUIRE_FILE_OUTPUT
 
 
-def test_continue_on_failure(cli_runner, project_tree, piped_shell_execute):
+def test_continue_on_failure(cli_runner, project_dirs, piped_shell_execute):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
-    root_b = str(project_tree.join("root_b"))
+    root_b = project_dirs["root_b"]
     base_args = ["--continue-on-failure", "-p", root_b]
 
     # All fail.
     command_args = base_args + ["does-not-exist"]
     result = cli_runner.invoke(deps_cli.cli, command_args)
     assert result.exit_code != 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    fnmatch_lines(
+        result.output,
         [
             "dep_z (1/4)",
             "Finished: dep_z in *s",
@@ -674,7 +708,7 @@ def test_continue_on_failure(cli_runner, project_tree, piped_shell_execute):
             "deps: error: Command failed (project: dep_b.1)",
             "deps: error: Command failed (project: root_b)",
             "Total time: *s",
-        ]
+        ],
     )
 
     # Some fail.
@@ -685,8 +719,8 @@ def test_continue_on_failure(cli_runner, project_tree, piped_shell_execute):
     command_args = base_args + [dir_or_ls, os.path.join("tasks", "asd.py")]
     result = cli_runner.invoke(deps_cli.cli, command_args)
     assert result.exit_code != 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    fnmatch_lines(
+        result.output,
         [
             "dep_z (1/4)",
             "Finished: dep_z in *s",
@@ -703,219 +737,155 @@ def test_continue_on_failure(cli_runner, project_tree, piped_shell_execute):
             "deps: error: Command failed (project: dep_b.1.1)",
             "deps: error: Command failed (project: dep_b.1)",
             "Total time: *s",
-        ]
+        ],
     )
 
     # None fail.
     command_args = base_args + ["echo", "This", "is", "{name}"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
+    result = invoke_deps(cli_runner, command_args)
     assert "deps: error: Command failed" not in result.output
 
 
-def test_list_repos(cli_runner, project_tree, piped_shell_execute):
-    """
-    :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
-    """
-    root = str(project_tree.join("root_c"))
-    base_args = ["-p", root, "--repos"]
-
-    command_args = base_args
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            "*[\\/]test_projects0[\\/]cs2",
-            "*[\\/]test_projects0[\\/]cs1",
-            "*[\\/]test_projects0[\\/]root_c",
-        ]
-    )
-
-    base_args = ["-p", root, "--repos"]
-    # Test pretty print.
-    command_args = base_args + ["-pp"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            "*[\\/]test_projects0[\\/]root_c",
-            "    *[\\/]test_projects0[\\/]cs1",
-            "        (*[\\/]test_projects0[\\/]cs1)",
-            "        *[\\/]test_projects0[\\/]cs2",
-            "            (*[\\/]test_projects0[\\/]cs1)",
-        ]
-    )
-
-
-def test_list_repos_with_ignored_project(cli_runner, project_tree, piped_shell_execute):
-    """
-    :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
-    """
-    root = str(project_tree.join("root_c"))
-    base_args = ["-p", root, "--repos"]
-
-    # Test pretty print.
-    command_args = base_args + ["--ignore-project=dep_c1.3", "-pp"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            "*[\\/]test_projects0[\\/]root_c",
-            "    *[\\/]test_projects0[\\/]cs1",
-            "        (*[\\/]test_projects0[\\/]cs1)",
-        ]
-    )
-
-    # Test pretty print.
-    command_args = base_args + ["--ignore-project=dep_c2.1", "-pp"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            "*[\\/]test_projects0[\\/]root_c",
-            "    *[\\/]test_projects0[\\/]cs1",
-            "        (*[\\/]test_projects0[\\/]cs1)",
-            "        <*[\\/]test_projects0[\\/]cs2>",
-        ]
-    )
-
-
-def test_list_repos_with_skipped_project(cli_runner, project_tree, piped_shell_execute):
-    """
-    :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
-    """
-    root = str(project_tree.join("root_c"))
-    base_args = ["-p", root, "--repos"]
-
-    # Test pretty print.
-    command_args = base_args + ["--skip-project=dep_c1.3", "-pp"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            "*[\\/]test_projects0[\\/]root_c",
-            "    *[\\/]test_projects0[\\/]cs1",
-            "        (*[\\/]test_projects0[\\/]cs1)",
-            "        *[\\/]test_projects0[\\/]cs2",
-            "            (*[\\/]test_projects0[\\/]cs1)",
-        ]
-    )
-
-    # Test pretty print.
-    command_args = base_args + ["--skip-project=dep_c2.1", "-pp"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            "*[\\/]test_projects0[\\/]root_c",
-            "    *[\\/]test_projects0[\\/]cs1",
-            "        (*[\\/]test_projects0[\\/]cs1)",
-            "        {*[\\/]test_projects0[\\/]cs2}",
-            "            (*[\\/]test_projects0[\\/]cs1)",
-        ]
-    )
-
-
-def test_list_repos_conflict_skipped_ignored_project(
-    cli_runner, project_tree, piped_shell_execute
-):
-    """
-    :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
-    """
-    root = str(project_tree.join("root_c"))
-    base_args = ["-p", root, "--repos"]
-
-    # Test pretty print.
-    command_args = base_args + [
-        "--skip-project=dep_c1.3",
-        "--ignore-project=dep_c1.3",
-        "-pp",
-    ]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            "*[\\/]test_projects0[\\/]root_c",
-            "    *[\\/]test_projects0[\\/]cs1",
-            "        (*[\\/]test_projects0[\\/]cs1)",
-        ]
-    )
-
-    # Test pretty print.
-    command_args = base_args + [
-        "--skip-project=dep_c2.1",
-        "--ignore-project=dep_c2.1",
-        "-pp",
-    ]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
-        [
-            "*[\\/]test_projects0[\\/]root_c",
-            "    *[\\/]test_projects0[\\/]cs1",
-            "        (*[\\/]test_projects0[\\/]cs1)",
-            "        <*[\\/]test_projects0[\\/]cs2>",
-        ]
-    )
-
-
-@pytest.mark.parametrize("mode", ["normal", "skipped"])
-def test_list_repos_precedence(mode, cli_runner, project_tree, piped_shell_execute):
+@pytest.mark.parametrize(
+    "project, extra_args, expected_lines",
+    [
+        pytest.param(
+            "root_c",
+            [],
+            [
+                "*[\\/]test_projects[\\/]cs2",
+                "*[\\/]test_projects[\\/]cs1",
+                "*[\\/]test_projects[\\/]root_c",
+            ],
+            id="list",
+        ),
+        pytest.param(
+            "root_c",
+            ["-pp"],
+            [
+                "*[\\/]test_projects[\\/]root_c",
+                "    *[\\/]test_projects[\\/]cs1",
+                "        (*[\\/]test_projects[\\/]cs1)",
+                "        *[\\/]test_projects[\\/]cs2",
+                "            (*[\\/]test_projects[\\/]cs1)",
+            ],
+            id="pretty-print",
+        ),
+        pytest.param(
+            "root_c",
+            ["--ignore-project=dep_c1.3", "-pp"],
+            [
+                "*[\\/]test_projects[\\/]root_c",
+                "    *[\\/]test_projects[\\/]cs1",
+                "        (*[\\/]test_projects[\\/]cs1)",
+            ],
+            id="ignored-project",
+        ),
+        pytest.param(
+            "root_c",
+            ["--ignore-project=dep_c2.1", "-pp"],
+            [
+                "*[\\/]test_projects[\\/]root_c",
+                "    *[\\/]test_projects[\\/]cs1",
+                "        (*[\\/]test_projects[\\/]cs1)",
+                "        <*[\\/]test_projects[\\/]cs2>",
+            ],
+            id="ignored-repo",
+        ),
+        pytest.param(
+            "root_c",
+            ["--skip-project=dep_c1.3", "-pp"],
+            [
+                "*[\\/]test_projects[\\/]root_c",
+                "    *[\\/]test_projects[\\/]cs1",
+                "        (*[\\/]test_projects[\\/]cs1)",
+                "        *[\\/]test_projects[\\/]cs2",
+                "            (*[\\/]test_projects[\\/]cs1)",
+            ],
+            id="skipped-project",
+        ),
+        pytest.param(
+            "root_c",
+            ["--skip-project=dep_c2.1", "-pp"],
+            [
+                "*[\\/]test_projects[\\/]root_c",
+                "    *[\\/]test_projects[\\/]cs1",
+                "        (*[\\/]test_projects[\\/]cs1)",
+                "        {*[\\/]test_projects[\\/]cs2}",
+                "            (*[\\/]test_projects[\\/]cs1)",
+            ],
+            id="skipped-repo",
+        ),
+        pytest.param(
+            "root_c",
+            ["--skip-project=dep_c1.3", "--ignore-project=dep_c1.3", "-pp"],
+            [
+                "*[\\/]test_projects[\\/]root_c",
+                "    *[\\/]test_projects[\\/]cs1",
+                "        (*[\\/]test_projects[\\/]cs1)",
+            ],
+            id="skipped-and-ignored-project",
+        ),
+        pytest.param(
+            "root_c",
+            ["--skip-project=dep_c2.1", "--ignore-project=dep_c2.1", "-pp"],
+            [
+                "*[\\/]test_projects[\\/]root_c",
+                "    *[\\/]test_projects[\\/]cs1",
+                "        (*[\\/]test_projects[\\/]cs1)",
+                "        <*[\\/]test_projects[\\/]cs2>",
+            ],
+            id="skipped-and-ignored-repo",
+        ),
+        # A repository is ignored/skipped only if all its projects are.
+        pytest.param(
+            "root_d",
+            ["-pp", "--ignore-project=d1", "--ignore-project=d2"],
+            [
+                "*[\\/]test_projects[\\/]root_d",
+                "    *[\\/]test_projects[\\/]d",
+            ],
+            id="precedence-normal",
+        ),
+        pytest.param(
+            "root_d",
+            [
+                "-pp",
+                "--ignore-project=d1",
+                "--ignore-project=d2",
+                "--skip-project=d3",
+            ],
+            [
+                "*[\\/]test_projects[\\/]root_d",
+                "    {*[\\/]test_projects[\\/]d}",
+            ],
+            id="precedence-skipped",
+        ),
+    ],
+)
+def test_list_repos(project, extra_args, expected_lines, cli_runner, project_dirs):
     """
+    :type project: str
+    :type extra_args: list(str)
+    :type expected_lines: list(str)
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
+    :type project_dirs: dict(str, str)
     """
-    root = str(project_tree.join("root_d"))
-    base_args = ["-p", root, "--repos"]
-
-    command_args = base_args + ["-pp", "--ignore-project=d1", "--ignore-project=d2"]
-    if mode == "skipped":
-        command_args.append("--skip-project=d3")
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    if mode == "skipped":
-        matcher.fnmatch_lines(
-            [
-                "*[\\/]test_projects0[\\/]root_d",
-                "    {*[\\/]test_projects0[\\/]d}",
-            ]
-        )
-    else:
-        assert mode == "normal"
-        matcher.fnmatch_lines(
-            [
-                "*[\\/]test_projects0[\\/]root_d",
-                "    *[\\/]test_projects0[\\/]d",
-            ]
-        )
+    root = project_dirs[project]
+    command_args = ["-p", root, "--repos"] + extra_args
+    result = invoke_deps(cli_runner, command_args)
+    fnmatch_lines(result.output, expected_lines)
 
 
-def test_deps_parallel_unordered(cli_runner, project_tree, monkeypatch):
+def test_deps_parallel_unordered(cli_runner, project_dirs, fake_shell_execute):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
+    :type project_dirs: dict(str, str)
+    :type fake_shell_execute: mocker.patch
     """
-    monkeypatch.chdir(project_tree.join("root_b"))
     command_args = [
+        "-p",
+        project_dirs["root_b"],
         "--jobs=2",
         "--jobs-unordered",
         "--",
@@ -924,10 +894,9 @@ def test_deps_parallel_unordered(cli_runner, project_tree, monkeypatch):
         '"name: {name}"',
     ]
 
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines_random(
+    result = invoke_deps(cli_runner, command_args)
+    fnmatch_lines_random(
+        result.output,
         [
             "=======================================================================================================================",
             "dep_z, dep_b.1.1, dep_b.1, root_b (4/4)",
@@ -935,115 +904,237 @@ def test_deps_parallel_unordered(cli_runner, project_tree, monkeypatch):
             "Finished: dep_b.1.1 in *",
             "Finished: root_b in *",
             "Finished: dep_b.1 in *",
-        ]
+        ],
     )
 
 
-def test_deps_parallel_unordered_error(
-    cli_runner, project_tree, monkeypatch, piped_shell_execute
-):
+def test_deps_parallel_unordered_error(cli_runner, project_dirs, piped_shell_execute):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
     task_script = os.path.join("tasks", "does-not-exist")
 
-    monkeypatch.chdir(project_tree.join("root_b"))
-    command_args = ["-v", "--jobs=2", "--jobs-unordered", task_script]
+    root_b = project_dirs["root_b"]
+    command_args = ["-p", root_b, "-v", "--jobs=2", "--jobs-unordered", task_script]
 
     result = cli_runner.invoke(deps_cli.cli, command_args)
     assert result.exit_code != 0
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines_random(
+    fnmatch_lines_random(
+        result.output,
         [
             "dep_z, dep_b.1.1, dep_b.1, root_b (4/4)",
             # We know that this will fail (it'll be the first). Others may fail or may be cancelled, we
             # can't guarantee.
             "deps: error: Command failed (project: dep_z)",
-        ]
+        ],
     )
 
 
-def test_deps_parallel(cli_runner, project_tree, monkeypatch):
+@pytest.mark.parametrize(
+    "root, expected_lines",
+    [
+        pytest.param(
+            "root_b",
+            [
+                "=======================================================================================================================",
+                "dep_z (1/4)",
+                "Finished: dep_z in *",
+                "=======================================================================================================================",
+                "dep_b.1.1 (2/4)",
+                "Finished: dep_b.1.1 in *",
+                "=======================================================================================================================",
+                "dep_b.1 (3/4)",
+                "Finished: dep_b.1 in *",
+                "=======================================================================================================================",
+                "root_b (4/4)",
+                "Finished: root_b in *",
+            ],
+            id="root_b",
+        ),
+        pytest.param(
+            "root_a",
+            [
+                "=======================================================================================================================",
+                "dep_z (1/6)",
+                "Finished: dep_z in *",
+                "=======================================================================================================================",
+                "dep_a.2, dep_a.1.1, dep_a.1.2 (4/6)",
+                "Finished: dep_a.2 in *",
+                "Finished: dep_a.1.1 in *",
+                "Finished: dep_a.1.2 in *",
+                "=======================================================================================================================",
+                "dep_a.1 (5/6)",
+                "Finished: dep_a.1 in *",
+                "=======================================================================================================================",
+                "root_a (6/6)",
+                "Finished: root_a in *",
+            ],
+            id="root_a",
+        ),
+    ],
+)
+def test_deps_parallel(
+    cli_runner, project_dirs, fake_shell_execute, root, expected_lines
+):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
+    :type project_dirs: dict(str, str)
+    :type fake_shell_execute: mocker.patch
+    :type root: str
+    :type expected_lines: list(str)
     """
-    monkeypatch.chdir(project_tree.join("root_b"))
-    command_args = ["--jobs=2", "--", "python", "-c", '"name: {name}"']
+    root_dir = project_dirs[root]
+    command_args = ["-p", root_dir, "--jobs=2", "--", "python", "-c", '"name: {name}"']
 
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines_random(
-        [
-            "=======================================================================================================================",
-            "dep_z (1/4)",
-            "Finished: dep_z in *",
-            "=======================================================================================================================",
-            "dep_b.1.1 (2/4)",
-            "Finished: dep_b.1.1 in *",
-            "=======================================================================================================================",
-            "dep_b.1 (3/4)",
-            "Finished: dep_b.1 in *",
-            "=======================================================================================================================",
-            "root_b (4/4)",
-            "Finished: root_b in *",
-        ]
+    result = invoke_deps(cli_runner, command_args)
+    fnmatch_lines_random(result.output, expected_lines)
+
+
+@pytest.fixture
+def scheduling_projects(tmp_path):
+    """
+    Projects to check the scheduling of parallel commands: `app` depends on `mid` and `slow`, and
+    `mid` depends on `fast`.
+
+    :type tmp_path: pathlib.Path
+    :rtype: str
+    :return: The directory of the `app` project.
+    """
+    projects = {"app": ["mid", "slow"], "mid": ["fast"], "fast": [], "slow": []}
+    for proj, deps in projects.items():
+        includes = "".join(
+            f"  - {tmp_path / dep / 'environment.devenv.yml'}\n" for dep in deps
+        )
+        (tmp_path / proj).mkdir()
+        (tmp_path / proj / "environment.devenv.yml").write_text(
+            f"name: {proj}\nincludes:\n{includes}" if deps else f"name: {proj}\n"
+        )
+    return str(tmp_path / "app")
+
+
+def controlled_shell_execute(mocker, returncodes, wait_for, started=None):
+    """
+    Replaces the execution of commands by one which records the order the projects start and
+    finish, where a project only finishes after the given event is set.
+
+    :param dict(str, int) returncodes: The return code of the projects (0 by default).
+    :param dict(str, threading.Event) wait_for: The event each project waits for to finish.
+    :param dict(str, threading.Event) started: The event set when each project starts (after its
+        start is recorded).
+    :rtype: list(str)
+    :return: The events recorded, like `"start mid"` or `"end mid"`.
+    """
+    events = []
+    started = started or {}
+
+    def _controlled_shell_execute(command, cwd, buffer_output=False):
+        name = os.path.basename(cwd)
+        events.append(f"start {name}")
+        if name in started:
+            started[name].set()
+        if name in wait_for:
+            assert wait_for[name].wait(timeout=10), f"timeout waiting in {name}"
+        events.append(f"end {name}")
+        returncode = returncodes.get(name, 0)
+        return subprocess.CompletedProcess(command, returncode), None, None, 0
+
+    mocker.patch("deps.deps_cli.shell_execute", new=_controlled_shell_execute)
+    return events
+
+
+def test_deps_parallel_starts_when_dependencies_finish(
+    cli_runner, scheduling_projects, mocker
+):
+    """
+    A project starts as soon as its own dependencies finish, even when an unrelated project
+    started before it is still executing.
+    """
+    mid_started = threading.Event()
+    # `slow` only finishes after `mid` (which depends on `fast`) starts.
+    events = controlled_shell_execute(
+        mocker, {}, {"slow": mid_started}, started={"mid": mid_started}
     )
+    command_args = ["-p", scheduling_projects, "--jobs=2", "--", "cmd"]
 
+    invoke_deps(cli_runner, command_args)
+    assert events.index("start mid") < events.index("end slow")
+    assert events[-2:] == ["start app", "end app"]
 
-def test_deps_parallel_2(cli_runner, project_tree, monkeypatch):
+
+def test_deps_parallel_failure_stops_new_projects(
+    cli_runner, scheduling_projects, mocker
+):
     """
-    :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
-    :type piped_shell_execute: mocker.patch
+    After a command fails no other project is started, but the ones already executing finish and
+    are reported.
     """
-    monkeypatch.chdir(project_tree.join("root_a"))
-    command_args = ["--jobs=2", "--", "python", "-c", '"name: {name}"']
+    fast_failed = threading.Event()
+    original_echo_error = deps_cli.echo_error
+
+    def echo_error(*args, **kwargs):
+        original_echo_error(*args, **kwargs)
+        fast_failed.set()
+
+    mocker.patch("deps.deps_cli.echo_error", new=echo_error)
+    # `slow` only finishes after the failure of `fast` is reported.
+    events = controlled_shell_execute(mocker, {"fast": 1}, {"slow": fast_failed})
+    command_args = ["-p", scheduling_projects, "--jobs=2", "--", "cmd"]
 
     result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines_random(
+    assert result.exit_code == 1, result.output
+    assert sorted(events) == ["end fast", "end slow", "start fast", "start slow"]
+    fnmatch_lines_random(
+        result.output,
         [
-            "=======================================================================================================================",
-            "dep_z (1/6)",
-            "Finished: dep_z in *",
-            "=======================================================================================================================",
-            "dep_a.2, dep_a.1.1, dep_a.1.2 (4/6)",
-            "Finished: dep_a.2 in *",
-            "Finished: dep_a.1.1 in *",
-            "Finished: dep_a.1.2 in *",
-            "=======================================================================================================================",
-            "dep_a.1 (5/6)",
-            "Finished: dep_a.1 in *",
-            "=======================================================================================================================",
-            "root_a (6/6)",
-            "Finished: root_a in *",
-        ]
+            "deps: error: Command failed (project: fast)",
+            "Finished: slow in *",
+        ],
     )
 
 
-def test_deps_parallel_3(cli_runner, project_tree, monkeypatch):
+def test_deps_parallel_3(cli_runner, project_dirs):
     """
     :type cli_runner: click.testing.CliRunner
-    :type project_tree: py.path.local
+    :type project_dirs: dict(str, str)
     :type piped_shell_execute: mocker.patch
     """
-    monkeypatch.chdir(project_tree.join("root_a"))
-    command_args = ["--jobs=2", "--", "python", "-c", 'import sys;print("foo")']
+    root_a = project_dirs["root_a"]
+    command_args = [
+        "-p",
+        root_a,
+        "--jobs=2",
+        "--",
+        "python",
+        "-c",
+        'import sys;print("foo")',
+    ]
 
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
+    result = invoke_deps(cli_runner, command_args)
     assert result.output.count("=== STDOUT ===") == 6
     assert result.output.count("foo") == 6
 
 
-def test_no_expected_env_file(cli_runner, tmpdir_factory, piped_shell_execute):
-    test_projects = tmpdir_factory.mktemp("test_projects")
+def test_deps_parallel_here(cli_runner, project_dirs, monkeypatch, tmp_path):
+    """
+    :type cli_runner: click.testing.CliRunner
+    :type project_dirs: dict(str, str)
+    :type monkeypatch: _pytest.monkeypatch
+    :type tmp_path: pathlib.Path
+    """
+    monkeypatch.chdir(tmp_path)
+    root_b = project_dirs["root_b"]
+    print_cwd = "import os;print(os.getcwd())"
+    command_args = ["-p", root_b, "--here", "--jobs=2", "--", "python", "-c", print_cwd]
+
+    result = invoke_deps(cli_runner, command_args)
+    # All the projects are executed in the current directory.
+    assert result.output.count("=== STDOUT ===") == 4
+    assert result.output.count(os.getcwd()) == 4
+
+
+def test_no_expected_env_file(cli_runner, tmp_path, piped_shell_execute):
     projects = {
         "expected_env_file": (
             "environment.devenv.yml",
@@ -1052,74 +1143,70 @@ def test_no_expected_env_file(cli_runner, tmpdir_factory, piped_shell_execute):
         "unexpected_env_file": ("foo_environment.devenv.yml", []),
     }
     for proj, (env_filename, deps) in projects.items():
-        proj_path = proj.split("/")
-        proj_dir = test_projects.ensure(*proj_path, dir=True)
-        env_yml = proj_dir.join(env_filename)
+        proj_dir = tmp_path / proj
+        proj_dir.mkdir(parents=True)
         env_content = ["name: {}".format(proj), ""]
         if len(deps) > 0:
             env_content.append("includes:")
             env_content.extend(["  - {{{{ root }}}}/{}".format(dep) for dep in deps])
             env_content.append("")
-        env_yml.write("\n".join(env_content))
+        (proj_dir / env_filename).write_text("\n".join(env_content))
 
-    root = str(test_projects.join("expected_env_file"))
+    root = os.fspath(tmp_path / "expected_env_file")
     # Prepare the invocation.
     command_args = ["-p", root, "echo", "test", "{name}"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
+    result = invoke_deps(cli_runner, command_args)
 
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    fnmatch_lines(
+        result.output,
         [
             "unexpected_env_file (1/2)",
             "test unexpected_env_file",
             "expected_env_file (2/2)",
             "test expected_env_file",
-        ]
+        ],
     )
 
 
-def test_empty_environment(cli_runner, tmpdir_factory, piped_shell_execute):
-    test_project = tmpdir_factory.mktemp("test_empty_environment")
-    proj_dir = test_project.ensure("project_with_empty_environment", dir=True)
-    env_yml = proj_dir.join("environment.devenv.yml")
-    env_yml.write("")
+def test_empty_environment(cli_runner, tmp_path, fake_shell_execute):
+    proj_dir = tmp_path / "project_with_empty_environment"
+    proj_dir.mkdir()
+    (proj_dir / "environment.devenv.yml").write_text("")
 
-    root = str(proj_dir)
+    root = os.fspath(proj_dir)
     command_args = ["-p", root, "echo", "test", "{name}"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
+    result = invoke_deps(cli_runner, command_args)
 
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    fnmatch_lines(
+        result.output,
         [
             "project_with_empty_environment (1/1)",
-        ]
+        ],
     )
 
 
-def test_empty_includes(cli_runner, tmpdir_factory, piped_shell_execute):
-    test_project = tmpdir_factory.mktemp("test_empty_includes")
-    proj_dir = test_project.ensure("project_with_empty_includes", dir=True)
-    env_yml = proj_dir.join("environment.devenv.yml")
-    env_yml.write("includes:")
+def test_empty_includes(cli_runner, tmp_path, fake_shell_execute):
+    proj_dir = tmp_path / "project_with_empty_includes"
+    proj_dir.mkdir()
+    (proj_dir / "environment.devenv.yml").write_text("includes:")
 
-    root = str(proj_dir)
+    root = os.fspath(proj_dir)
     command_args = ["-p", root, "echo", "test", "{name}"]
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
+    result = invoke_deps(cli_runner, command_args)
 
-    matcher = LineMatcher(result.output.splitlines())
-    matcher.fnmatch_lines(
+    fnmatch_lines(
+        result.output,
         [
             "project_with_empty_includes (1/1)",
-        ]
+        ],
     )
 
 
-def test_work_dir(cli_runner, project_tree, monkeypatch, capfd):
+def test_work_dir(cli_runner, project_dirs, capfd):
     # Use Python to get the work directory and just write a file to it (contents do not matter).
     command_args = [
+        "-p",
+        project_dirs["root_b"],
         "--",
         "python",
         "-c",
@@ -1129,12 +1216,240 @@ def test_work_dir(cli_runner, project_tree, monkeypatch, capfd):
         "print(d);"
         "d.joinpath('foo').write_text('hello')",
     ]
-    monkeypatch.chdir(project_tree.join("root_b"))
-    result = cli_runner.invoke(deps_cli.cli, command_args)
-    assert result.exit_code == 0, result.output
+    result = invoke_deps(cli_runner, command_args)
     lines = [x.strip() for x in capfd.readouterr().out.splitlines()]
     # Ensure each project printed the work directory, and ensure they all used the same one.
     assert len(lines) == 4
     assert len(set(lines)) == 1
     # Ensure the work directory no longer exists at this point.
     assert not Path(lines[0]).is_dir()
+
+
+def test_includes_cache(cli_runner, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("DEPS_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(deps_cli, "_includes_cache_changed", False)
+    monkeypatch.setattr(deps_cli, "_includes_cache_directory", str(cache_dir))
+
+    lib_env = tmp_path / "lib" / "environment.devenv.yml"
+    lib_env.parent.mkdir()
+    lib_env.write_text("name: lib\n")
+    app_env = tmp_path / "app" / "environment.devenv.yml"
+    app_env.parent.mkdir()
+    app_env.write_text(f"name: app\nincludes:\n  - {lib_env}\n")
+    # Only the most recently used entries are kept, dropping the ones of files no longer used.
+    monkeypatch.setattr(deps_cli, "INCLUDES_CACHE_MAX_ENTRIES", 2)
+    removed_env = tmp_path / "removed" / "environment.devenv.yml"
+    monkeypatch.setattr(deps_cli, "_includes_cache", {str(removed_env): ((0, 0), [])})
+
+    result = invoke_deps(cli_runner, ["-p", str(app_env.parent)])
+    assert result.output == "lib\napp\n"
+
+    deps_cli._save_includes_cache()
+    with (cache_dir / "includes.json").open() as f:
+        cache = json.load(f)
+    st = app_env.stat()
+    assert cache == {
+        str(app_env): [[st.st_mtime_ns, st.st_size], [str(lib_env)]],
+        str(lib_env): [[lib_env.stat().st_mtime_ns, lib_env.stat().st_size], []],
+    }
+
+    # The saved cache is used by the next invocations.
+    monkeypatch.setattr(deps_cli, "_includes_cache", None)
+    assert deps_cli._get_includes_cache()[str(app_env)] == (
+        (st.st_mtime_ns, st.st_size),
+        [str(lib_env)],
+    )
+
+
+def test_includes_cache_keeps_used_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(deps_cli, "INCLUDES_CACHE_MAX_ENTRIES", 2)
+    monkeypatch.setattr(deps_cli, "_includes_cache", {})
+    monkeypatch.setattr(deps_cli, "_includes_cache_changed", False)
+    monkeypatch.setattr(deps_cli, "_includes_cache_directory", str(tmp_path))
+
+    def read(name):
+        env_file = tmp_path / name / "environment.devenv.yml"
+        if not env_file.is_file():
+            env_file.parent.mkdir()
+            env_file.write_text(f"name: {name}\n")
+        st = env_file.stat()
+        # Not memoized, as each call stands for a new `deps` invocation.
+        deps_cli._get_shallow_dependencies.__wrapped__(
+            str(env_file), (st.st_mtime_ns, st.st_size)
+        )
+
+    # `stable` is used by every invocation, so it is kept even though it was stored first.
+    for name in ["stable", "a", "stable", "b", "stable", "c"]:
+        read(name)
+    deps_cli._save_includes_cache()
+    with (tmp_path / "includes.json").open() as f:
+        cache = json.load(f)
+    assert list(cache) == [
+        str(tmp_path / "stable" / "environment.devenv.yml"),
+        str(tmp_path / "c" / "environment.devenv.yml"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        "not json",
+        "[]",
+        '{"environment.devenv.yml": 1}',
+        '{"environment.devenv.yml": [[0, 0], [1]]}',
+    ],
+)
+def test_invalid_includes_cache(tmp_path, monkeypatch, capsys, contents):
+    monkeypatch.setenv("DEPS_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(deps_cli, "_includes_cache", None)
+    monkeypatch.setattr(deps_cli, "_includes_cache_directory", None)
+    (tmp_path / "includes.json").write_text(contents)
+
+    assert deps_cli._get_includes_cache() == {}
+    assert "deps: ignoring invalid cache file" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_directory_included_with_another_file_name(cli_runner, tmp_path, jobs):
+    """
+    Only the first environment file a directory is included with is read (the others may not even
+    exist).
+    """
+    lib_dir = tmp_path / "lib"
+    lib_dir.mkdir()
+    (lib_dir / "environment.devenv.yml").write_text("name: lib\n")
+    app_env = tmp_path / "app" / "environment.devenv.yml"
+    app_env.parent.mkdir()
+    app_env.write_text(
+        f"name: app\nincludes:\n  - {lib_dir}/environment.devenv.yml\n"
+        f"  - {lib_dir}/missing.devenv.yml\n"
+    )
+    result = invoke_deps(cli_runner, ["-p", str(app_env.parent), "-j", jobs])
+    assert result.output == "lib\napp\n"
+
+
+def test_created_environment_file_is_found(cli_runner, tmp_path):
+    """
+    The ancestor directories found by an invocation are not reused by the next ones.
+    """
+    (tmp_path / "app" / "environment.devenv.yml").parent.mkdir()
+    (tmp_path / "app" / "environment.devenv.yml").write_text("name: app\n")
+    sub_dir = tmp_path / "app" / "sub"
+    sub_dir.mkdir()
+    result = invoke_deps(cli_runner, ["-p", str(sub_dir)])
+    assert result.output == "app\n"
+
+    (sub_dir / "environment.devenv.yml").write_text("name: sub\n")
+    result = invoke_deps(cli_runner, ["-p", str(sub_dir)])
+    assert result.output == "sub\n"
+
+
+@pytest.mark.parametrize(
+    "include, is_template",
+    [
+        ("{{ root }}/../lib/environment.devenv.yml", False),
+        ("{{root}}/../lib/environment.devenv.yml", False),
+        ("{{ root }}/../{{ 'lib' }}/environment.devenv.yml", True),
+    ],
+)
+def test_read_includes_root_template(tmp_path, include, is_template):
+    """
+    Templates using only `{{ root }}` are rendered without jinja (and can be cached on disk).
+    """
+    env_file = tmp_path / "app" / "environment.devenv.yml"
+    env_file.parent.mkdir()
+    env_file.write_text(f"name: app\nincludes:\n  - {include}\n")
+    expected = f"{env_file.parent}/../lib/environment.devenv.yml"
+    assert deps_cli._read_includes(str(env_file)) == ([expected], is_template)
+
+
+def test_execute_shell_builtin(tmp_path):
+    """
+    Commands are executed through the shell, so its builtins can be used.
+    """
+    returncode, stdout, stderr, _ = deps_cli.execute(
+        ["cd", ".."], str(tmp_path), buffer_output=True
+    )
+    assert (returncode, stderr) == (0, b"")
+
+
+def test_changed_environment_file_is_read_again(cli_runner, tmp_path):
+    """
+    The includes of environment files are memoized in-process (so the tests sharing
+    `project_tree` parse each file only once), but a changed file must be read again.
+    """
+    lib_env = tmp_path / "lib" / "environment.devenv.yml"
+    lib_env.parent.mkdir()
+    lib_env.write_text("name: lib\n")
+    app_env = tmp_path / "app" / "environment.devenv.yml"
+    app_env.parent.mkdir()
+    app_env.write_text(f"name: app\nincludes:\n  - {lib_env}\n")
+
+    result = invoke_deps(cli_runner, ["-p", str(app_env.parent)])
+    assert result.output == "lib\napp\n"
+
+    app_env.write_text("name: app\n")
+    result = invoke_deps(cli_runner, ["-p", str(app_env.parent)])
+    assert result.output == "app\n"
+
+
+def test_includes_cache_clear(tmp_path, monkeypatch):
+    monkeypatch.setattr(deps_cli, "_includes_cache", None)
+    monkeypatch.setattr(deps_cli, "_includes_cache_changed", False)
+    monkeypatch.setattr(deps_cli, "_includes_cache_directory", None)
+    app_env = tmp_path / "app" / "environment.devenv.yml"
+    app_env.parent.mkdir()
+    app_env.write_text(
+        f"name: app\nincludes:\n  - {tmp_path}/a/environment.devenv.yml\n"
+    )
+    st = app_env.stat()
+    app_dir = str(app_env.parent)
+    expected = [(str(tmp_path / "a"), "environment.devenv.yml")]
+    assert deps_cli.get_shallow_dependencies(app_dir) == expected
+
+    # Same size and modification time: the memoized includes are still used...
+    app_env.write_text(
+        f"name: app\nincludes:\n  - {tmp_path}/b/environment.devenv.yml\n"
+    )
+    os.utime(app_env, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert deps_cli.get_shallow_dependencies(app_dir) == expected
+
+    # ...until the memoized and cached includes are cleared.
+    deps_cli._get_shallow_dependencies.cache_clear()
+    monkeypatch.setattr(deps_cli, "_includes_cache", None)
+    expected = [(str(tmp_path / "b"), "environment.devenv.yml")]
+    assert deps_cli.get_shallow_dependencies(app_dir) == expected
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "name: a\n",
+        "name: a\nincludes:\n",
+        "name: a\nincludes:\n  - /b/environment.devenv.yml\n  - ../c/environment.devenv.yml\n",
+        "includes: # comment\n- /b/env.yml # comment\n\n# comment\n- C:\\c\\env.yml\nname: a\n",
+        "name: a\nincludes:\n  - /b/env.yml\ndependencies:\n  - python\n",
+    ],
+)
+def test_parse_includes_fast(text):
+    import yaml
+
+    expected = (yaml.safe_load(text) or {}).get("includes") or []
+    assert deps_cli._parse_includes_fast(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "base: &base\n  - /b/env.yml\nincludes: *base\n",
+        "includes: [/b/env.yml]\n",
+        "includes:\n  - '/b/env.yml'\n",
+        "includes:\n  - /b/env.yml\n    /c/env.yml\n",
+        "includes:\n  - /b/env.yml\n  - 1.5\n",
+        "includes:\n  - /b/env.yml\nincludes:\n  - /c/env.yml\n",
+        "---\nincludes:\n  - /b/env.yml\n",
+    ],
+)
+def test_parse_includes_fast_fallback(text):
+    assert deps_cli._parse_includes_fast(text) is None
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
+import atexit
 import functools
 import io
+import json
 import os
 import platform
+import re
+import shlex
 import subprocess
 import sys
-import textwrap
+import threading
 from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkstemp
 
 import click
 
@@ -59,6 +63,11 @@ def echo_error(*args, **kwargs):
 # ==================================================================================================
 
 FILE_WITH_DEPENDENCIES = "environment.devenv.yml"
+JINJA_MARKERS = ("{{", "{%", "{#")
+JINJA_ROOT_RE = re.compile(r"\{\{\s*root\s*\}\}")
+INCLUDES_CACHE_FILENAME = "includes.json"
+# The persistent includes cache keeps only the most recently used entries.
+INCLUDES_CACHE_MAX_ENTRIES = 10000
 
 
 def memoize(fun):
@@ -74,10 +83,156 @@ def memoize(fun):
             ret = cache[key] = fun(*args, **kwargs)
             return ret
 
+    wrapper.cache_clear = cache.clear
     return wrapper
 
 
-@memoize
+# Persistent cache of the `includes` of environment files, maps the absolute path of a file to a
+# `((mtime_ns, size), includes)` tuple. It is loaded lazily (from `_includes_cache_directory`) and
+# saved when the process exits.
+_includes_cache = None
+_includes_cache_changed = False
+_includes_cache_directory = None
+# The includes may be read from multiple threads (see `read_all_includes`).
+_includes_cache_lock = threading.Lock()
+
+
+def get_cache_directory():
+    """
+    :rtype: unicode | None
+    :return: The directory where `deps` keeps its persistent caches or `None` when caching is
+        disabled (`DEPS_CACHE_DIR` environment variable set to an empty value).
+    """
+    cache_directory = os.environ.get("DEPS_CACHE_DIR")
+    if cache_directory is not None:
+        return cache_directory or None
+    if sys.platform == "win32":
+        base_directory = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base_directory = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+            "~/.cache"
+        )
+    return os.path.join(base_directory, PROG_NAME)
+
+
+def _get_includes_cache():
+    """
+    :rtype: dict
+    :return: The persistent includes cache, loading it on the first call.
+    """
+    with _includes_cache_lock:
+        if _includes_cache is None:
+            _load_includes_cache()
+    return _includes_cache
+
+
+def _load_includes_cache():
+    global _includes_cache, _includes_cache_directory
+    _includes_cache = {}
+    _includes_cache_directory = cache_directory = get_cache_directory()
+    if cache_directory is None:
+        return
+    cache_file = os.path.join(cache_directory, INCLUDES_CACHE_FILENAME)
+    try:
+        with open(cache_file, "r") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        # A corrupted (or incompatible) cache is not fatal, it is just rebuilt.
+        echo_verbose_msg("ignoring invalid cache file {}: {}".format(cache_file, e))
+        return
+    cache = _parse_includes_cache(data)
+    if cache is None:
+        echo_verbose_msg("ignoring invalid cache file {}".format(cache_file))
+        return
+    _includes_cache = cache
+
+
+def _parse_includes_cache(data):
+    """
+    :param object data: The contents of the includes cache file, as loaded from JSON.
+    :rtype: dict | None
+    :return: The includes cache (see `_includes_cache`) or `None` if `data` is not a valid cache.
+    """
+    if not isinstance(data, dict):
+        return None
+    cache = {}
+    for env_file, entry in data.items():
+        try:
+            (mtime_ns, size), includes = entry
+        except (TypeError, ValueError):
+            return None
+        if not (
+            isinstance(mtime_ns, int)
+            and isinstance(size, int)
+            and isinstance(includes, list)
+            and all(isinstance(p, str) for p in includes)
+        ):
+            return None
+        cache[env_file] = ((mtime_ns, size), includes)
+    return cache
+
+
+def _get_cached_includes(env_file, stamp):
+    """
+    :rtype: list(unicode) | None
+    :return: The cached includes of the given file, or `None` if they are not cached for the given
+        stamp. A cached entry becomes the most recently used one.
+    """
+    cache = _get_includes_cache()
+    with _includes_cache_lock:
+        cached = cache.get(env_file)
+        if cached is None or cached[0] != stamp:
+            return None
+        # Moved to the end, as only the most recently used entries are kept when saving.
+        del cache[env_file]
+        cache[env_file] = cached
+    return cached[1]
+
+
+def _store_includes_in_cache(env_file, stamp, includes):
+    global _includes_cache_changed
+    cache = _get_includes_cache()
+    with _includes_cache_lock:
+        # Moved to the end, as only the most recently used entries are kept when saving.
+        cache.pop(env_file, None)
+        cache[env_file] = (stamp, includes)
+        _includes_cache_changed = True
+
+
+@atexit.register
+def _save_includes_cache():
+    """
+    Writes the includes cache (if it was changed) to the directory it was loaded from, keeping
+    only the `INCLUDES_CACHE_MAX_ENTRIES` most recently used entries (so entries of files which no
+    longer exist are eventually dropped). The file is replaced atomically so concurrent `deps`
+    invocations never see a partially written cache.
+    """
+    global _includes_cache_changed
+    cache_directory = _includes_cache_directory
+    if not _includes_cache_changed or cache_directory is None:
+        return
+    entries = list(_includes_cache.items())
+    cache = dict(entries[-INCLUDES_CACHE_MAX_ENTRIES:])
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        fd, temp_file = mkstemp(dir=cache_directory, prefix=INCLUDES_CACHE_FILENAME)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(
+                temp_file, os.path.join(cache_directory, INCLUDES_CACHE_FILENAME)
+            )
+        except BaseException:
+            os.remove(temp_file)
+            raise
+    except OSError:
+        # Caching is an optimization, failing to save it must not fail the command.
+        return
+    _includes_cache_changed = False
+
+
 def get_shallow_dependencies(base_directory, filename=None):
     """
     :param unicode base_directory:
@@ -88,26 +243,152 @@ def get_shallow_dependencies(base_directory, filename=None):
     :return: The first level (does not recursively list dependencies of dependencies) dependencies
     of the project rooted in the given directory
     """
-    import jinja2
-    import yaml
-
     if filename is None:
         filename = FILE_WITH_DEPENDENCIES
 
-    # NOTE: From [conda-devenv](https://conda-devenv.readthedocs.io/en/latest/usage.html#jinja2)
-    jinja_args = {"root": base_directory, "os": os, "sys": sys, "platform": platform}
+    env_file = os.path.join(os.path.abspath(base_directory), filename)
+    st = os.stat(env_file)
+    # The modification time and size are part of the memoization key so a changed file is read
+    # again.
+    return _get_shallow_dependencies(env_file, (st.st_mtime_ns, st.st_size))
 
-    with open(os.path.join(base_directory, filename), "r") as f:
-        yaml_contents = jinja2.Template(f.read()).render(**jinja_args)
 
-    data = yaml.safe_load(yaml_contents) or {}
-    if not data.get("includes"):
-        return []
-    includes = [os.path.abspath(p) for p in data["includes"]]
+@memoize
+def _get_shallow_dependencies(env_file, stamp):
+    """
+    Actual implementation of `get_shallow_dependencies`, memoized by the environment file path and
+    its `(mtime_ns, size)` stamp. The includes of files which are not jinja templates are also kept
+    in the persistent includes cache so other `deps` invocations don't have to parse them again.
+    """
+    includes = _get_cached_includes(env_file, stamp)
+    if includes is None:
+        includes, is_template = _read_includes(env_file)
+        if not is_template:
+            _store_includes_in_cache(env_file, stamp, includes)
+
+    # Same as `os.path.abspath`, but querying the current directory only once.
+    cwd = os.getcwd()
+    includes = [os.path.normpath(os.path.join(cwd, p)) for p in includes]
     includes = [(os.path.dirname(p), os.path.basename(p)) for p in includes]
     return includes
 
 
+def _read_includes(env_file):
+    """
+    :param unicode env_file: The environment definition file.
+    :rtype: tuple(list(unicode), bool)
+    :return: The raw `includes` entries of the file and if the file is a jinja template (the result
+        of rendering a template depends on the environment, so it must not be cached on disk).
+    """
+    with open(env_file, "r") as f:
+        text = f.read()
+    # Most files have no jinja markup at all, so skip the (relatively expensive) template
+    # compilation and rendering for those (and even the YAML parsing when possible).
+    is_template = any(marker in text for marker in JINJA_MARKERS)
+    if is_template:
+        # Templates using only `{{ root }}` (the usual way to include sibling projects) are
+        # rendered with a plain replacement, and depend only on the file location.
+        root = os.path.dirname(env_file)
+        rendered = JINJA_ROOT_RE.sub(lambda match: root, text)
+        if not any(marker in rendered for marker in JINJA_MARKERS):
+            text = rendered
+            is_template = False
+    if not is_template:
+        includes = _parse_includes_fast(text)
+        if includes is not None:
+            return includes, False
+
+    import yaml
+
+    # Prefer the LibYAML based loader (much faster), falling back to the pure Python one when
+    # PyYAML was built without LibYAML.
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
+    if is_template:
+        # NOTE: From [conda-devenv](https://conda-devenv.readthedocs.io/en/latest/usage.html#jinja2)
+        jinja_args = {
+            "root": os.path.dirname(env_file),
+            "os": os,
+            "sys": sys,
+            "platform": platform,
+        }
+        yaml_contents = _get_jinja_environment().from_string(text).render(**jinja_args)
+    else:
+        yaml_contents = text
+
+    data = yaml.load(yaml_contents, Loader=SafeLoader) or {}
+    return list(data.get("includes") or []), is_template
+
+
+# The top level `includes:` key (without an inline value) and an entry of its block list which is
+# a plain path (no quotes, flow collections, etc), used by `_parse_includes_fast`.
+INCLUDES_KEY_RE = re.compile(r"includes:(?: +#.*)?[ ]*$")
+INCLUDES_ENTRY_RE = re.compile(r"( *)- +([^\s'\"#|>%@`{}\[\],][^\s#]*)(?: +#.*)?[ ]*$")
+
+
+def _parse_includes_fast(text):
+    """
+    Extracts the `includes` of an environment file without parsing it as YAML, which is possible
+    for the (most common) simple files: the includes (if any) are a top level block list of plain
+    paths.
+
+    :param unicode text: The contents of an environment file (which is not a jinja template).
+    :rtype: list(unicode) | None
+    :return: The `includes` entries or `None` if the file is not simple enough, so it must be
+        parsed as YAML.
+    """
+    # Anchors, aliases, tags and tabs could change what is included in ways only YAML knows.
+    if any(c in text for c in "&*!\t"):
+        return None
+    lines = text.splitlines()
+    if any(line.startswith(("%", "---", "...")) for line in lines):
+        return None
+    key_lines = [i for i, line in enumerate(lines) if line.startswith("includes")]
+    if len(key_lines) > 1 or text.count("includes") != len(key_lines):
+        return None
+    if not key_lines:
+        return []
+    if not INCLUDES_KEY_RE.match(lines[key_lines[0]]):
+        return None
+
+    includes = []
+    indentation = None
+    for line in lines[key_lines[0] + 1 :]:
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        match = INCLUDES_ENTRY_RE.match(line)
+        if match is None:
+            if line.startswith((" ", "-")):
+                return None
+            break  # The next top level key.
+        entry_indentation, entry = match.groups()
+        if indentation is None:
+            indentation = entry_indentation
+        # Only paths: other plain scalars could be resolved to something else (`null`, numbers...).
+        if entry_indentation != indentation or entry.endswith(":"):
+            return None
+        if "/" not in entry and "\\" not in entry:
+            return None
+        includes.append(entry)
+    return includes
+
+
+@memoize
+def _get_jinja_environment():
+    """
+    :rtype: jinja2.Environment
+    :return: The environment shared by all the environment files which are jinja templates
+        (instead of setting one up for each template).
+    """
+    import jinja2
+
+    return jinja2.Environment()
+
+
 # ==================================================================================================
 # Common code
 # ==================================================================================================
@@ -116,6 +397,9 @@ _Dep = namedtuple("Dep", "name,abspath,deps,ignored,skipped")
 
 class Dep(_Dep):
 
+    # No per-instance `__dict__` (as the namedtuple itself), keeping each node as small as a tuple.
+    __slots__ = ()
+
     # Overridden to make identity compares (unlike namedtuple which would compare the contents). In
     # practice, this is needed because the deps is a list, so, Dep couldn't be used as a dict key
     # or in a set.
@@ -139,7 +423,8 @@ def create_new_dep_from_directory(directory, ignore_projects, skipped_projects):
     if a name is in both lists it will be always ignored.
     :rtype: Dep
     """
-    directory = os.path.abspath(directory)
+    # Interned, as `abspath` is used as key by the visited sets/dicts of every traversal.
+    directory = sys.intern(os.path.abspath(directory))
     name = os.path.split(directory)[1]
     return Dep(
         name=name,
@@ -150,6 +435,14 @@ def create_new_dep_from_directory(directory, ignore_projects, skipped_projects):
     )
 
 
+DEPENDENCY_TREE_LEGEND = """\
+# - project_name: listed or target of command execution;
+# - (project_name): have already been printed in the tree;
+# - <project_name>: have been ignored (see `--ignore-project` option);
+# - {project_name}: have been skipped (see `--skipped-project` option);
+"""
+
+
 def pretty_print_dependency_tree(root_deps):
     """
     Prints an indented tree for the projects (and their dependencies). A short legend is printed
@@ -159,37 +452,34 @@ def pretty_print_dependency_tree(root_deps):
     """
     already_printed = set()
 
-    legend = textwrap.dedent(
-        """\
-        # - project_name: listed or target of command execution;
-        # - (project_name): have already been printed in the tree;
-        # - <project_name>: have been ignored (see `--ignore-project` option);
-        # - {project_name}: have been skipped (see `--skipped-project` option);
-    """
-    )
-    print(legend)
+    print(DEPENDENCY_TREE_LEGEND)
 
     def print_formatted_dep(name, identation, name_template="{}"):
         print(identation + name_template.format(name))
 
-    def print_deps(dep_list, indentation_size=0, indentation_string="    "):
+    indentation_string = "    "
+    # Pre-order traversal using an explicit stack of `(dep, indentation_size)` (instead of
+    # recursion, which could hit the recursion limit on deep trees). Items are pushed in reverse
+    # so they are popped (and printed) in their original order.
+    stack = [(dep, 0) for dep in reversed(root_deps)]
+    while stack:
+        dep, indentation_size = stack.pop()
         indentation = indentation_string * indentation_size
-        next_indentation_size = indentation_size + 1
-        for dep in dep_list:
-            if dep.ignored:
-                print_formatted_dep(dep.name, indentation, "<{}>")
-                continue
-            if dep.abspath not in already_printed:
-                if dep.skipped:
-                    print_formatted_dep(dep.name, indentation, "{{{}}}")
-                else:
-                    print_formatted_dep(dep.name, indentation)
-                already_printed.add(dep.abspath)
-                print_deps(dep.deps, next_indentation_size, indentation_string)
+        if dep.ignored:
+            print_formatted_dep(dep.name, indentation, "<{}>")
+            continue
+        if dep.abspath not in already_printed:
+            if dep.skipped:
+                print_formatted_dep(dep.name, indentation, "{{{}}}")
             else:
-                print_formatted_dep(dep.name, indentation, "({})")
-
-    print_deps(root_deps)
+                print_formatted_dep(dep.name, indentation)
+            already_printed.add(dep.abspath)
+            next_indentation_size = indentation_size + 1
+            stack.extend(
+                (sub_dep, next_indentation_size) for sub_dep in reversed(dep.deps)
+            )
+        else:
+            print_formatted_dep(dep.name, indentation, "({})")
 
 
 def find_ancestor_dir_with(filename, begin_in=None):
@@ -204,8 +494,16 @@ def find_ancestor_dir_with(filename, begin_in=None):
     """
     if begin_in is None:
         begin_in = os.curdir
+    return _find_ancestor_dir_with(filename, os.path.abspath(begin_in))
+
 
-    base_directory = os.path.abspath(begin_in)
+@functools.lru_cache(maxsize=4096)
+def _find_ancestor_dir_with(filename, base_directory):
+    """
+    Implementation of `find_ancestor_dir_with` (`base_directory` must be absolute), cached since
+    many projects share the same ancestors (for instance, projects in the same repository). The
+    cache is cleared on each `cli` invocation.
+    """
     while True:
         directory = base_directory
         if os.path.exists(os.path.join(directory, filename)):
@@ -234,8 +532,11 @@ def find_directories(raw_directories):
 
     directories = []
 
+    cwd = os.getcwd()
     for raw_dir in raw_directories:
-        directory = find_ancestor_dir_with(FILE_WITH_DEPENDENCIES, raw_dir)
+        directory = find_ancestor_dir_with(
+            FILE_WITH_DEPENDENCIES, os.path.join(cwd, raw_dir)
+        )
         if directory is None:
             msg = 'could not find "{}" for "{}".'.format(
                 FILE_WITH_DEPENDENCIES, raw_dir
@@ -247,8 +548,60 @@ def find_directories(raw_directories):
     return directories
 
 
+def read_all_includes(root_directories, ignored_projects, jobs=1):
+    """
+    Reads the includes of all projects reachable from the given root directories. The environment
+    files are read one "level" of the dependency graph at a time, all files in a level being read
+    concurrently when `jobs > 1` (reading is mostly I/O bound, so threads are used).
+
+    Each directory is read only once, with the first environment file name it is reached with. A
+    file which can't be read doesn't fail here: its error is raised by the future's `result()`.
+
+    :param sequence[unicode] root_directories: The root directories identifying projects.
+    :param sequence[unicode] ignored_projects: Project names whose includes are not read.
+    :param int jobs: The number of threads used to read the files.
+
+    :rtype: dict(unicode,tuple(unicode|None,concurrent.futures.Future))
+    :return: Maps the directory of each project to the environment file name it was read with and
+        the future for its shallow dependencies (see `get_shallow_dependencies`).
+    """
+    if jobs > 1:
+        from concurrent.futures.thread import ThreadPoolExecutor
+
+        executor = ThreadPoolExecutor(max_workers=jobs)
+    else:
+        from ._synchronous_executor import SynchronousExecutor
+
+        executor = SynchronousExecutor()
+
+    all_includes = {}
+    to_read = [(p, None) for p in root_directories]
+    try:
+        while to_read:
+            level_futures = []
+            for directory, env_filename in to_read:
+                if directory in all_includes:
+                    continue
+                name = os.path.basename(os.path.abspath(directory))
+                if name in ignored_projects:
+                    continue
+                future = executor.submit(
+                    get_shallow_dependencies, directory, env_filename
+                )
+                all_includes[directory] = (env_filename, future)
+                level_futures.append(future)
+
+            to_read = []
+            for future in level_futures:
+                if future.exception() is None:
+                    to_read.extend(future.result())
+    finally:
+        executor.shutdown(wait=True)
+    return all_includes
+
+
 def obtain_all_dependecies_recursively(
-    root_directories, ignored_projects, skipped_projects
+    root_directories, ignored_projects, skipped_projects, jobs=1
 ):
     """
     Creates a list with a `Dep` for each item in `root_directories` where each project is inspected
@@ -259,38 +612,49 @@ def obtain_all_dependecies_recursively(
         recurse into its dependencies).
     :param sequence[unicode] skipped_projects: Project names to be marked as skipped (it still
         recurse into its dependencies).
+    :param int jobs: The number of threads used to read the projects' environment files.
 
     :rtype: list(Dep)
     :return: The created list.
     """
+    all_includes = read_all_includes(root_directories, ignored_projects, jobs)
+
     all_deps = {}
+    root_deps = []
 
-    def add_deps_from_directories(directories, list_to_add_deps):
-        """
-        A data structure (`Dep`) is created for each project rooted in the given directories.
+    # Depth-first traversal using an explicit stack (instead of recursion, which could hit the
+    # recursion limit on deep dependency chains). Each entry holds the iterator of the
+    # `(directory, env_filename)` pairs still to be processed and the list which receives the
+    # `Dep`s created for them (shared `Dep`s are reused when multiple projects have the same
+    # dependency). Using iterators keeps the same visiting order of a recursive traversal.
+    stack = [(iter([(p, None) for p in root_directories]), root_deps)]
+    while stack:
+        directories, list_to_add_deps = stack[-1]
+        entry = next(directories, None)
+        if entry is None:
+            stack.pop()
+            continue
+        dep_directory, dep_env_filename = entry
 
-        :param sequence(tuple(unicode,unicode)) directories: Projects' roots to use.
-        :param list(Dep) list_to_add_deps: A list to be populated with the created `Dep`s
-        processed `Dep`s (in case multiple projects have the same dependency).
-        """
-        for dep_directory, dep_env_filename in directories:
-            if dep_directory not in all_deps:
-                dep = create_new_dep_from_directory(
-                    dep_directory, ignored_projects, skipped_projects
-                )
-                all_deps[dep_directory] = dep
-                if not dep.ignored:
+        dep = all_deps.get(dep_directory)
+        if dep is None:
+            dep = create_new_dep_from_directory(
+                dep_directory, ignored_projects, skipped_projects
+            )
+            all_deps[dep_directory] = dep
+            if not dep.ignored:
+                env_filename, future = all_includes.get(dep_directory, (None, None))
+                if future is not None and env_filename == dep_env_filename:
+                    current_dep_directories = future.result()
+                else:
+                    # The directory was read with another file name (not the one it is first
+                    # reached with by this traversal), or not read at all.
                     current_dep_directories = get_shallow_dependencies(
                         dep_directory, dep_env_filename
                     )
-                    add_deps_from_directories(current_dep_directories, dep.deps)
-            else:
-                dep = all_deps[dep_directory]
-            list_to_add_deps.append(dep)
+                stack.append((iter(current_dep_directories), dep.deps))
+        list_to_add_deps.append(dep)
 
-    root_deps = []
-    root_directories = [(p, None) for p in root_directories]
-    add_deps_from_directories(root_directories, root_deps)
     return root_deps
 
 
@@ -309,7 +673,7 @@ def obtain_repos(dep_list):
         :return: The repository for the given project. Conserve the `ignored` property.
         """
         directory = find_ancestor_dir_with(".git", dep.abspath)
-        directory = os.path.abspath(directory)
+        directory = sys.intern(os.path.abspath(directory))
         repo_key = (directory, dep.ignored)
         if repo_key not in all_repos:
             all_repos[repo_key] = Dep(
@@ -321,7 +685,7 @@ def obtain_repos(dep_list):
             )
         return all_repos[repo_key]
 
-    visited_deps = []
+    visited_deps = set()
 
     def convert_deps_to_repos(deps, list_of_repos, parent):
         """
@@ -333,7 +697,7 @@ def obtain_repos(dep_list):
         for dep in deps:
             if (parent, dep) in visited_deps:
                 continue
-            visited_deps.append((parent, dep))
+            visited_deps.add((parent, dep))
             repo = obtain_repo_from_dep(dep)
             convert_deps_to_repos(dep.deps, repo.deps, dep.name)
             if repo not in list_of_repos:
@@ -355,7 +719,7 @@ def obtain_repos(dep_list):
                 if saved.ignored:
                     precedence[repo_dep.name] = repo_dep
 
-        precedence_values = list(precedence.values())
+        precedence_values = set(precedence.values())
         for repo_dep in list_of_repos[:]:
             if repo_dep not in precedence_values:
                 list_of_repos.remove(repo_dep)
@@ -413,17 +777,10 @@ def obtain_dependencies_ordered_for_execution(root_deps):
         :param Dep dep:
         :rtype: int
         """
-        already_visited = {dep.abspath}
-        other_deps = dep.deps[:]
-        count = 0
-        while other_deps:
-            next_dep = other_deps.pop()
-            if next_dep.abspath in already_visited:
-                continue
-            count += 1
-            other_deps.extend(next_dep.deps)
-            already_visited.add(next_dep.abspath)
-        return count
+        # Reuse the (memoized) transitive dependencies instead of walking the graph again; the
+        # dep itself is part of them when it is in a cycle.
+        all_deps = get_abs_path_to_dep_for_all_deps(dep)
+        return len(all_deps) - (dep.abspath in all_deps)
 
     deps = []
     already_counted_deps = set()
@@ -447,6 +804,10 @@ def obtain_dependencies_ordered_for_execution(root_deps):
     return [dep_element for dep_element, dep_count in deps]
 
 
+# Matches the variables which may be used in commands (see `format_command`).
+COMMAND_VARIABLES_RE = re.compile(r"\{(name|abs)\}")
+
+
 def format_command(command, dep):
     """
     Process the variables in command.
@@ -461,21 +822,15 @@ def format_command(command, dep):
         "abs": dep.abspath,
     }
 
-    def _format(s, format_dict):
-        """
-        :type s: unicode
-        :type format_dict: dict(unicode,unicode)
-
-        :rtype: unicode
-        """
-        for key, item in format_dict.items():
-            s = s.replace("{" + key + "}", item)
-        return s
+    def replace_variable(match):
+        return format_dict[match.group(1)]
 
+    # Note: `str.format` is not used because any other "{" or "}" in the command must be kept
+    # as is (for instance, in `python -c` code).
     if isinstance(command, (list, tuple)):
-        return [_format(a, format_dict) for a in command]
+        return [COMMAND_VARIABLES_RE.sub(replace_variable, a) for a in command]
     else:
-        return _format(command, format_dict)
+        return COMMAND_VARIABLES_RE.sub(replace_variable, command)
 
 
 def execute_command_in_dependencies(
@@ -497,7 +852,7 @@ def execute_command_in_dependencies(
     :param list(Dep) dependencies: The list of dependencies for which execute the command.
 
     :param callable required_files_filter: A list os files required in a dependency root directory
-        to execute the command.
+        to execute the command (`None` if there are no required files).
 
     :param bool dry_run: Does all the checks and most output normally but does not actually execute
         the command.
@@ -524,65 +879,109 @@ def execute_command_in_dependencies(
     exit_codes = []
     error_messages = []
     initial = [x.name for x in dependencies]
+    dependencies = list(dependencies)
     buffer_output = False
     on_github = "GITHUB_WORKSPACE" in os.environ
     output_separator = "" if on_github else "\n" + "=" * MAX_LINE_LENGTH
 
+    # Maps the futures of the commands being executed to their dependency (in submission order).
+    running = {}
+
     if jobs > 1:
         buffer_output = True
+        from concurrent.futures import FIRST_COMPLETED, wait
         from concurrent.futures.thread import ThreadPoolExecutor
 
         executor = ThreadPoolExecutor(max_workers=jobs)
-        previously_added_to_batch = set()
 
-        def calculate_next_batch(dependencies):
-            next_batch = []
-            if jobs_unordered:
-                next_batch.extend(dependencies)
+        def wait_for_finished():
+            done = wait(running, return_when=FIRST_COMPLETED).done
+            return [future for future in running if future in done]
+
+        if jobs_unordered:
+
+            def calculate_next_batch():
+                next_batch = dependencies[:]
                 del dependencies[:]
-            else:
-                msg = []
-                for i, dep in reversed(list(enumerate(dependencies))):
-                    for depends_on in get_abs_path_to_dep_for_all_deps(dep).values():
-                        if depends_on not in previously_added_to_batch:
-                            msg.append(
-                                "{} still depending on: {}".format(
-                                    dep.name, depends_on.name
+                return next_batch
+
+            def mark_finished(dep):
+                pass
+
+        else:
+            # Topological scheduling: a dependency is ready to execute as soon as all of its
+            # (direct and indirect) dependencies have finished, without waiting for unrelated
+            # dependencies which happen to be executing concurrently.
+            finished = []
+            dependency_index = {dep: i for i, dep in enumerate(dependencies)}
+            waiting_count = {}
+            dependents = {}
+            for dep in dependencies:
+                depends_on = get_abs_path_to_dep_for_all_deps(dep)
+                waiting_count[dep] = len(depends_on)
+                for depends_on_key in depends_on:
+                    dependents.setdefault(depends_on_key, []).append(dep)
+            ready = {dep for dep, count in waiting_count.items() if count == 0}
+
+            def calculate_next_batch():
+                next_batch = sorted(ready, key=dependency_index.get, reverse=True)
+                ready.clear()
+                for dep in next_batch:
+                    dependencies.remove(dep)
+
+                if not next_batch and dependencies and not running:
+                    finished_keys = {dep.abspath for dep in finished}
+                    msg = []
+                    for dep in reversed(dependencies):
+                        for key, depends_on in get_abs_path_to_dep_for_all_deps(
+                            dep
+                        ).items():
+                            if key not in finished_keys:
+                                msg.append(
+                                    "{} still depending on: {}".format(
+                                        dep.name, depends_on.name
+                                    )
                                 )
-                            )
-                            break
-                    else:
-                        next_batch.append(dependencies.pop(i))
-
-                if not next_batch and dependencies:
+                                break
                     raise AssertionError(
                         "No batch calculated and dependencies still available.\n\n"
                         "Remaining:\n%s\n\nFinished:\n%s\n\nAll:\n%s"
                         % (
                             "\n".join(msg),
-                            "\n".join(str(x.name) for x in previously_added_to_batch),
+                            "\n".join(str(x.name) for x in finished),
                             "\n".join(initial),
                         )
                     )
+                return next_batch
 
-            previously_added_to_batch.update(next_batch)
-            return next_batch
+            def mark_finished(dep):
+                finished.append(dep)
+                for dependent in dependents.get(dep.abspath, ()):
+                    waiting_count[dependent] -= 1
+                    if waiting_count[dependent] == 0:
+                        ready.add(dependent)
 
     else:
         from ._synchronous_executor import SynchronousExecutor
 
         executor = SynchronousExecutor()
 
-        def calculate_next_batch(dependencies):
+        def wait_for_finished():
+            # Futures of the synchronous executor are finished as soon as they're submitted.
+            return list(running)
+
+        def calculate_next_batch():
             # The next is the first one in the list.
             return [dependencies.pop(0)]
 
-    progress = 0
-    total_progress = len(dependencies)
-    while len(dependencies) > 0:
-        deps = calculate_next_batch(dependencies)
-        progress += len(deps)
-        dep_to_future = {}
+        def mark_finished(dep):
+            pass
+
+    def submit_batch(deps):
+        """
+        Prints the header of the given batch and submits the command of each dependency for
+        execution (dependencies which won't execute the command are finished right away).
+        """
         first = True
         print_str = ", ".join(dep.name for dep in deps)
         for dep in deps:
@@ -604,6 +1003,7 @@ def execute_command_in_dependencies(
                         nl=False,
                     )
                 click.secho(" ignored", fg="yellow", color=_click_echo_color)
+                mark_finished(dep)
                 continue
 
             if dep.skipped:
@@ -618,9 +1018,13 @@ def execute_command_in_dependencies(
                         nl=False,
                     )
                 click.secho(" skipped", fg="magenta", color=_click_echo_color)
+                mark_finished(dep)
                 continue
 
-            if not required_files_filter(dep, quiet=False):
+            if required_files_filter is not None and not required_files_filter(
+                dep, quiet=False
+            ):
+                mark_finished(dep)
                 continue
 
             formatted_command = format_command(command, dep)
@@ -643,14 +1047,30 @@ def execute_command_in_dependencies(
                 if working_dir:
                     echo_verbose_msg("from:      " + working_dir)
 
-            if not dry_run:
-                dep_to_future[dep] = executor.submit(
+            if dry_run:
+                mark_finished(dep)
+            else:
+                future = executor.submit(
                     execute, formatted_command, working_dir, buffer_output
                 )
+                running[future] = dep
 
             first = False
 
-        for dep, future in dep_to_future.items():
+    progress = 0
+    total_progress = len(dependencies)
+    keep_on_going = True
+    while running or (keep_on_going and dependencies):
+        if keep_on_going and dependencies:
+            deps = calculate_next_batch()
+            if deps:
+                progress += len(deps)
+                submit_batch(deps)
+            if not running:
+                continue
+
+        for future in wait_for_finished():
+            dep = running.pop(future)
             try:
                 returncode, stdout, stderr, command_time = future.result()
             except Exception as e:
@@ -697,19 +1117,13 @@ def execute_command_in_dependencies(
                 echo_error(error_msg)
 
                 if not continue_on_failure:
-                    # Cancel what can be cancelled in case we had a failure.
-                    for f in dep_to_future.values():
-                        f.cancel()
-
-        if not continue_on_failure:
-            keep_on_going = True
-            for returncode in exit_codes:
-                if returncode != 0:
+                    # Cancel what can be cancelled in case we had a failure (and don't start
+                    # anything else).
                     keep_on_going = False
-                    break
+                    for f in running:
+                        f.cancel()
 
-            if not keep_on_going:
-                break
+            mark_finished(dep)
 
     # If we have errors and we kept on going or executed multiple jobs, print a summary of the
     # errors at the end.
@@ -744,11 +1158,7 @@ def execute(formatted_command, working_dir, buffer_output=False):
         A tuple with (returncode, stdout, stderr, time to execute command).
     """
     if not sys.platform.startswith("win"):
-        import pipes
-
-        for index, item in enumerate(formatted_command):
-            formatted_command[index] = pipes.quote(item)
-        formatted_command = " ".join(formatted_command)
+        formatted_command = shlex.join(formatted_command)
 
     if working_dir is None:
         cwd = None
@@ -832,7 +1242,11 @@ def execute(formatted_command, working_dir, buffer_output=False):
     " instead of projects them selves",
 )
 @click.option(
-    "--jobs", "-j", default=1, help="Run commands in parallel using multiple processes"
+    "--jobs",
+    "-j",
+    default=1,
+    help="Run commands (and read the projects' environment files) in parallel using multiple"
+    " threads.",
 )
 @click.option(
     "--jobs-unordered",
@@ -917,6 +1331,8 @@ def cli(
     initial_time = time.time()
     global _click_echo_color
     original_auto_wrap_for_ansi = click.utils.auto_wrap_for_ansi
+    # Files may have been created or removed since a previous invocation in this process.
+    _find_ancestor_dir_with.cache_clear()
     try:
         if force_color:
             _click_echo_color = True
@@ -929,7 +1345,7 @@ def cli(
         directories = find_directories(project)
 
         root_deps = obtain_all_dependecies_recursively(
-            directories, ignore_project, skip_project
+            directories, ignore_project, skip_project, jobs
         )
         if repos:
             root_deps = obtain_repos(root_deps)
@@ -939,6 +1355,9 @@ def cli(
             pretty_print_dependency_tree(root_deps)
             return 0
 
+        # Only the entries with variables (see `format_command`) must be formatted per project.
+        required_files = [(f, "{" in f) for f in require_file]
+
         def required_files_filter(dependency, quiet):
             """
             :type dependency: Dep
@@ -946,13 +1365,12 @@ def cli(
 
             :return: `True` if the necessary files/folders are present, `False` otherwise.
             """
-            for f in require_file:
-                file_to_check = os.path.join(
-                    dependency.abspath, format_command(f, dependency)
-                )
-                if not os.path.isfile(file_to_check) and not os.path.isdir(
-                    file_to_check
-                ):
+            for f, has_variables in required_files:
+                if has_variables:
+                    f = format_command(f, dependency)
+                file_to_check = os.path.join(dependency.abspath, f)
+                # A single `stat` call (instead of `isfile` followed by `isdir`).
+                if not os.path.exists(file_to_check):
                     if not quiet:
                         msg = '{}: skipping since "{}" does not exist'
                         msg = msg.format(dependency.name, file_to_check)
@@ -960,6 +1378,10 @@ def cli(
                     return False
             return True
 
+        if not required_files:
+            # Nothing to check for any project (the common case).
+            required_files_filter = None
+
         deps_in_order = obtain_dependencies_ordered_for_execution(root_deps)
 
         if deps_reversed:
@@ -971,7 +1393,10 @@ def cli(
                 for dep in deps_in_order
                 if not dep.ignored
                 and not dep.skipped
-                and required_files_filter(dep, quiet=True)
+                and (
+                    required_files_filter is None
+                    or required_files_filter(dep, quiet=True)
+                )
             ]
             print("\n".join(deps_to_output))
             return 0
@@ -1029,22 +1454,15 @@ def shell_execute(command, cwd, buffer_output=False):
     :param bool buffer_output:
         If True the output of the process in piped and properly returned afterwards.
 
-    :return tuple(subprocess.Popen, unicode, unicode, float):
+    :return tuple(subprocess.CompletedProcess, unicode, unicode, float):
         Return tuple with the process object used to run the command, stdout, stderr, time to execute.
     """
     import time
 
     curtime = time.time()
-    # Note: could use something like this for more robustness:
-    # http://stackoverflow.com/questions/13243807/popen-waiting-for-child-process-even-when-the-immediate-child-has-terminated/13256908#13256908
-    if buffer_output:
-        process = subprocess.Popen(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=cwd
-        )
-    else:
-        process = subprocess.Popen(command, shell=True, cwd=cwd)
-    stdout, stderr = process.communicate()
-    return process, stdout, stderr, time.time() - curtime
+    output = subprocess.PIPE if buffer_output else None
+    process = subprocess.run(command, stdout=output, stderr=output, shell=True, cwd=cwd)
+    return process, process.stdout, process.stderr, time.time() - curtime
 
 
 def main_func():
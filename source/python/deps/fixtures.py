@@ -2,13 +2,13 @@ import pytest
 from click.testing import CliRunner
 
 
-@pytest.yield_fixture
+@pytest.fixture
 def cli_runner():
     """
     Fixture used to test click applications.
     :rtype: click.testing.CliRunner
     """
-    yield CliRunner()
+    return CliRunner()
 
 
 @pytest.fixture
@@ -36,3 +36,21 @@ def piped_shell_execute(mocker):
         new=_piped_shell_execute,
     )
     return shell_execute
+
+
+@pytest.fixture
+def fake_shell_execute(mocker):
+    """
+    Replaces the execution of commands by one which succeeds right away, without spawning any
+    process, for tests which only check what deps does around the commands (not their output).
+    """
+    import subprocess
+
+    def _fake_shell_execute(command, cwd, buffer_output=False):
+        return subprocess.CompletedProcess(command, returncode=0), None, None, 0
+
+    shell_execute = mocker.patch(
+        "deps.deps_cli.shell_execute",
+        new=_fake_shell_execute,
+    )
+    return shell_execute